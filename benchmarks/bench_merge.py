@@ -0,0 +1,94 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import parallel_prowler  # noqa: E402
+
+"""
+Benchmarks merging per-account Prowler output into one results CSV
+
+Compares the old resultDict split loop against merge_results() on
+synthetic output for a configurable number of accounts
+"""
+
+HEADER = ("PROFILE,ACCOUNT_NUM,REGION,TITLE_ID,RESULT,SCORED,LEVEL,"
+          "TITLE_TEXT,NOTES")
+
+
+def setup_args(parser):
+    parser.add_argument("-a", "--accounts", type=int, default=500,
+                        help="Number of synthetic accounts [500]")
+    parser.add_argument("-n", "--rows", type=int, default=2000,
+                        help="Findings per account [2000]")
+    parser.add_argument("-s", "--skipLegacy", action="store_true",
+                        help="Only time merge_results()")
+
+
+def make_output(outdir, accounts, rows):
+    fileNames = []
+    for a in range(accounts):
+        profile = 'bench' + str(a)
+        account = str(100000000000 + a)
+        lines = [HEADER]
+        for r in range(rows):
+            lines.append('{},{},us-east-1,{}.{},{},Scored,Level 1,'
+                         '"Synthetic check {}",resource-{}'.format(
+                             profile, account, r % 4, r % 20,
+                             'PASS' if r % 3 else 'FAIL', r % 20, r))
+        fname = os.path.join(outdir, 'prowler-' + profile + '.csv')
+        f = open(fname, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        fileNames.append(fname)
+    return fileNames
+
+
+def legacy_merge(resultFileName, fileNames):
+    # The pre-merge_results() algorithm, kept here for comparison
+    resultDict = {}
+    for fname in fileNames:
+        resultDict[fname] = open(fname).read()
+    header = False
+    resultFile = open(resultFileName, 'w+')
+    for key in resultDict:
+        for i in range(len(resultDict[key].split('\n'))):
+            if header:
+                if 'ACCOUNT_NUM' not in resultDict[key].split('\n')[i]:
+                    resultFile.write(resultDict[key].split('\n')[i] + "\n")
+            else:
+                resultFile.write(resultDict[key].split('\n')[0] + "\n")
+                header = True
+    resultFile.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    setup_args(parser)
+    args = parser.parse_args()
+    parallel_prowler.verbose = False
+    outdir = tempfile.mkdtemp(prefix='bench_merge-')
+    try:
+        fileNames = make_output(outdir, args.accounts, args.rows)
+        print("Accounts: {}, Findings per account: {}".format(
+            args.accounts, args.rows))
+        start = time.perf_counter()
+        parallel_prowler.merge_results(os.path.join(outdir, 'merged.csv'),
+                                       fileNames)
+        print("merge_results: {:.3f}s".format(time.perf_counter() - start))
+        if not args.skipLegacy:
+            start = time.perf_counter()
+            legacy_merge(os.path.join(outdir, 'legacy.csv'), fileNames)
+            print("legacy split loop: {:.3f}s".format(
+                time.perf_counter() - start))
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
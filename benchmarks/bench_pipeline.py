@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import parallel_prowler  # noqa: E402
+
+"""
+End-to-end benchmark of parallel_prowler.py without AWS accounts
+
+Runs benchmarks/fake_prowler in place of prowler and a local stand-in for
+the credential check, then times each stage: profile validation, scan
+orchestration, the merge and process_results(). Timings and peak RSS are
+written as JSON so runs can be compared over time.
+"""
+
+
+def setup_args(parser):
+    parser.add_argument("-a", "--accounts", type=int, default=50,
+                        help="Number of synthetic accounts [50]")
+    parser.add_argument("-c", "--checks", type=int, default=50,
+                        help="Checks per account [50]")
+    parser.add_argument("-n", "--rows", type=int, default=10,
+                        help="Findings per check [10]")
+    parser.add_argument("-L", "--latency", type=float, default=0.5,
+                        help="Seconds each fake Prowler run takes [0.5]")
+    parser.add_argument("-N", "--noteSize", type=int, default=40,
+                        help="Bytes in each NOTES value [40]")
+    parser.add_argument("-V", "--validationLatency", type=float,
+                        default=0.2,
+                        help="Seconds each stand-in credential check "
+                        "takes [0.2]")
+    parser.add_argument("-t", "--maxthreads", type=int,
+                        help="Passed to parallel_prowler.py --maxthreads")
+    parser.add_argument("-o", "--output", type=str,
+                        help="JSON results file. Defaults to "
+                        "bench_pipeline-<timestamp>.json")
+    parser.add_argument("-k", "--keep", action="store_true",
+                        help="Keep the scan output directory")
+
+
+def fake_check_profile(latency):
+    # Local stand-in for parallel_prowler.check_profile()
+    def check_profile(profile):
+        time.sleep(latency)
+        return True
+    return check_profile
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        'children': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    setup_args(parser)
+    args = parser.parse_args()
+    os.environ['FAKE_PROWLER_CHECKS'] = str(args.checks)
+    os.environ['FAKE_PROWLER_ROWS'] = str(args.rows)
+    os.environ['FAKE_PROWLER_LATENCY'] = str(args.latency)
+    os.environ['FAKE_PROWLER_NOTES'] = str(args.noteSize)
+    outdir = tempfile.mkdtemp(prefix='bench_pipeline-')
+    fakeProwler = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'fake_prowler')
+    ppArgs = ['-pp', fakeProwler, '-o', outdir, '--profileCacheTTL', '0']
+    if args.maxthreads:
+        ppArgs += ['-t', str(args.maxthreads)]
+    pp = parallel_prowler
+    ppParser = argparse.ArgumentParser()
+    pp.setup_args(ppParser)
+    pp.args = ppParser.parse_args(ppArgs)
+    pp.check_args_outputDir(pp.args)
+    logging.basicConfig(filename=outdir + '/assessment.log',
+                        format='%(levelname)s:%(message)s', level='INFO')
+    pp.verbose = False
+    pp.prowlerPath = fakeProwler
+    pp.check_profile = fake_check_profile(args.validationLatency)
+    profiles = ['bench' + str(i) for i in range(args.accounts)]
+    stages = {}
+
+    def stage(name, func, *funcArgs):
+        start = time.perf_counter()
+        result = func(*funcArgs)
+        stages[name] = {'seconds': round(time.perf_counter() - start, 4),
+                        'peakRssKb': peak_rss_kb()}
+        print("{}: {:.3f}s".format(name, stages[name]['seconds']))
+        return result
+
+    try:
+        working = stage('validation', pp.validate_profiles, profiles)
+        pp.resultDict = {}
+        pp.durationDict = {}
+        pp.scanUUID = uuid.uuid4()
+        pp.scanTime = time.time()
+        units = pp.build_units([p for p, works in working if works])
+        pp.new_manifest(units)
+        maxthreads = args.maxthreads or 4 * (os.cpu_count() or 1)
+        stage('scan', asyncio.run, pp.run_scan(units, 1, maxthreads))
+        resultFileName = outdir + '/results-bench.csv'
+        stage('merge', pp.merge_results, resultFileName,
+              [pp.resultDict[pp.unit_key(u)] for u in units
+               if pp.unit_key(u) in pp.resultDict])
+        stage('process_results', pp.process_results, resultFileName)
+        results = {
+            'timestamp': int(time.time()),
+            'parameters': vars(args),
+            'units': len(units),
+            'resultBytes': os.path.getsize(resultFileName),
+            'stages': stages}
+        output = args.output or 'bench_pipeline-{}.json'.format(
+            results['timestamp'])
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Benchmark Results: " + output)
+    finally:
+        if args.keep:
+            print("Scan Output: " + outdir)
+        else:
+            shutil.rmtree(outdir)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
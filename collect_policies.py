@@ -1,149 +1,534 @@
 import argparse
 import boto3
+import csv
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import concurrent.futures
+import functools
+import glob
 import json
 import logging
 import os
 from progressbar import ProgressBar
+import queue
+import random
+import re
 import sys
+import threading
+import time
 
 """
 Collects IAM Policies
 
-Evaluates policies looking for badness (*.*, Effect:Allow + NotAction)
-
-Need to add more tests/use cases
+Evaluates every statement of every policy against the rules in RULES
+(*.*, Effect:Allow + NotAction, ...). Add a rule by decorating a function
+that takes a normalized statement with @rule.
 """
 
 
-def get_policies(profile):
-    session = boto3.session.Session(profile_name=profile)
-    myiam = session.client('iam')
-    marker = None
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequestsException']
+
+
+def call_with_backoff(func, **kwargs):
+    # Retry throttled IAM calls with exponential backoff and jitter
+    attempt = 0
+    while True:
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            if (e.response['Error']['Code'] not in THROTTLE_CODES
+                    or attempt >= 8):
+                raise
+            delay = min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+            logging.debug("Throttled, retrying in {:.1f}s".format(delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def cache_key(p):
+    # A policy whose key is unchanged needs no further API calls
+    return [p['DefaultVersionId'], str(p['UpdateDate']),
+            p.get('AttachmentCount')]
+
+
+def cache_fresh(entry, p):
+    # Attachments can change without touching the policy, so they are
+    # only trusted for --entityMaxAge hours
+    global args
+    return (entry is not None and entry['key'] == cache_key(p)
+            and time.time() - entry.get('fetched', 0)
+            < args.entityMaxAge * 3600)
+
+
+def load_policy_cache(account):
+    global args
+    fname = os.path.join(args.cacheDir, account + '.json')
+    if args.refresh or not os.path.exists(fname):
+        return {}
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Unreadable policy cache: " + fname)
+        logging.error(e)
+        return {}
+
+
+def save_policy_cache(account, cache):
+    global args
+    os.makedirs(args.cacheDir, exist_ok=True)
+    fname = os.path.join(args.cacheDir, account + '.json')
+    with open(fname + '.tmp', 'w') as f:
+        f.write(json.dumps(cache, default=str))
+    os.replace(fname + '.tmp', fname)
+
+
+RULES = []
+
+
+def rule(label):
+    # Register a rule. It gets a statement from normalize_statements()
+    # and returns True when the statement should be reviewed.
+    def register(func):
+        RULES.append((func.__name__, label, func))
+        return func
+    return register
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern):
+    # IAM wildcards: * is any run of characters, ? is one character
+    return re.compile(re.escape(pattern).replace('\\*', '.*')
+                      .replace('\\?', '.'))
+
+
+def as_set(value, lower):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [value]
+    return frozenset(v.lower() if lower else v for v in value)
+
+
+def normalize_statements(document):
+    # Statement may be one dict or a list; Action, NotAction, Resource and
+    # NotResource may each be a string or a list. Actions are lowercased
+    # since IAM matches them case-insensitively.
+    statements = document['Statement']
+    if isinstance(statements, dict):
+        statements = [statements]
+    return [{'effect': st['Effect'],
+             'action': as_set(st.get('Action'), True),
+             'notaction': as_set(st.get('NotAction'), True),
+             'resource': as_set(st.get('Resource'), False),
+             'notresource': as_set(st.get('NotResource'), False)}
+            for st in statements]
+
+
+def grants(st, action):
+    # Does an Allow statement cover `action` (e.g. 'iam:passrole')?
+    if st['effect'] != 'Allow':
+        return False
+    if st['action'] is not None:
+        return any(compile_pattern(p).fullmatch(action)
+                   for p in st['action'])
+    return not any(compile_pattern(p).fullmatch(action)
+                   for p in st['notaction'] or [])
+
+
+# Pattern 1: Allow *.*
+
+# AWSLambdaRole {
+# 'Version': '2012-10-17',
+# 'Statement': [
+#   {'Effect': 'Allow',
+#   'Action': '*',
+#   'Resource': ['*']
+#   }
+# ]
+# }
+def matches_all(pattern):
+    # '*', '*:*', '**' ... match every action: apart from the colon they
+    # are only made of '*', the one wildcard that also matches nothing
+    return all(part and compile_pattern(part).fullmatch('')
+               for part in pattern.split(':', 1))
+
+
+@rule('Dangerous')
+def allow_all(st):
+    return (st['effect'] == 'Allow' and st['action'] is not None
+            and any(matches_all(p) for p in st['action'])
+            and st['resource'] is not None and '*' in st['resource'])
+
+
+# Pattern 2: Allow: *, NotAction
+
+# {'Version': '2012-10-17',
+# 'Statement': [
+#   {
+#       'Effect': 'Allow',
+#       'NotAction': ['iam:*', 'organizations:*', 'account:*'],
+#       'Resource': '*'
+#   },
+#   {
+#       'Effect': 'Allow',
+#       'Action': [ 'iam:CreateServiceLinkedRole',
+#                   'iam:DeleteServiceLinkedRole',
+#                   'iam:ListRoles',
+#                   'organizations:DescribeOrganization',
+#                   'account:ListRegions'
+#                 ],
+#       'Resource': '*'
+#   }
+# ]}
+# This policy blacklists all 'iam:*', 'organizations:*', and
+#   'accounts:*' with the NotAction. Then it grants specific
+#   access in the next stanza ('iam:ListRoles', etc)
+# The fatal flaw is that it grants access to everything else,
+# like lambda or ec2 because of the "Allow" in the first stanza.
+# This user can create an EC2 instance, attach an admin role to
+# it, and login and give themselves access to Admin. Instance
+# privilege escalation.
+@rule('Suspect')
+def allow_not_action(st):
+    return (st['effect'] == 'Allow' and st['notaction'] is not None
+            and st['resource'] is not None and '*' in st['resource'])
+
+
+# Pattern 3: iam:PassRole on any role lets the holder hand any role,
+# including admin roles, to a service they control
+@rule('Dangerous')
+def pass_any_role(st):
+    return (grants(st, 'iam:passrole') and st['resource'] is not None
+            and '*' in st['resource'])
+
+
+# Pattern 4: Allow + NotResource grants the actions on every resource
+# except the listed ones
+@rule('Suspect')
+def allow_not_resource(st):
+    return st['effect'] == 'Allow' and st['notresource'] is not None
+
+
+def analyze_document(item):
+    # Runs in the process pool: (profile, policy name, document) -> findings
+    profile, name, document = item
+    try:
+        statements = normalize_statements(document)
+    except (KeyError, TypeError, AttributeError) as e:
+        return [(profile, name, 'unparseable', 'Problem parsing', str(e))]
+    findings = []
+    for ruleName, label, func in RULES:
+        if any(func(st) for st in statements):
+            findings.append((profile, name, ruleName, label, document))
+    return findings
+
+
+def analyze_policies(allPolicies):
+    # Evaluate every statement against RULES across a process pool.
+    # allPolicies holds (profile, policy record) pairs from any number of
+    # accounts.
+    global args
+    items = [(profile, p['Policy']['PolicyName'],
+              p['PolicyVersion']['Document'])
+             for profile, p in allPolicies]
+    findings = []
+    print("\tChecking for Dangerous Policies")
+    if args.workers > 1 and len(items) > 100:
+        chunksize = max(1, len(items) // (args.workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+            for result in pool.map(analyze_document, items,
+                                   chunksize=chunksize):
+                findings += result
+    else:
+        for item in items:
+            findings += analyze_document(item)
+    for profile, name, ruleName, label, detail in findings:
+        if ruleName == 'unparseable':
+            print("Problem parsing this policy: {}/{}: {}".format(
+                profile, name, detail))
+            logging.debug("Problem parsing this policy: {}/{}: {}".format(
+                profile, name, detail))
+        else:
+            print("Review {} Policy: {}/{} ({}) -> {}".format(
+                label, profile, name, ruleName, detail))
+    return findings
+
+
+def write_report(findings):
+    # One cross-account CSV of every policy flagged by a rule
+    global args
+    fname = os.path.join(args.outputDir, 'dangerous-policies-{}.csv'.format(
+        int(time.time())))
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['PROFILE', 'POLICY', 'RULE', 'LABEL', 'DOCUMENT'])
+        for profile, name, ruleName, label, detail in sorted(
+                findings, key=lambda x: (x[0], x[1], x[2])):
+            if not isinstance(detail, str):
+                detail = json.dumps(detail, default=str)
+            writer.writerow([profile, name, ruleName, label, detail])
+    print("Policy Report: " + fname)
+
+
+def load_policy_files(folder):
+    # Previously collected {'Policy', 'PolicyVersion'} records
     allPolicies = []
-    passcount = 1
+    for fname in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        with open(fname, 'r') as f:
+            allPolicies.append(json.load(f))
+    return allPolicies
+
+
+def load_local_policies():
+    # -A: the single account layout in <outputDir>/policies plus every
+    # account's <outputDir>/<profile>/policies folder
+    global args
+    allPolicies = [('local', p) for p in load_policy_files(
+        os.path.join(args.outputDir, 'policies'))]
+    for folder in sorted(glob.glob(os.path.join(args.outputDir, '*',
+                                                'policies'))):
+        profile = os.path.basename(os.path.dirname(folder))
+        allPolicies += [(profile, p) for p in load_policy_files(folder)]
+    return allPolicies
+
+
+def fetch_policy(myiam, p, cached=None):
+    # The version document is reused from the cache when only the
+    # attachments changed
+    if cached and cached['key'][0] == p['DefaultVersionId']:
+        mypol = {'Policy': p, 'PolicyVersion': cached['PolicyVersion']}
+    else:
+        polVers = call_with_backoff(myiam.get_policy_version,
+                                    PolicyArn=p['Arn'],
+                                    VersionId=p['DefaultVersionId'])
+        mypol = {'Policy': p, 'PolicyVersion': polVers['PolicyVersion']}
+    ae = {'PolicyGroups': [], 'PolicyUsers': [], 'PolicyRoles': []}
+    marker = None
+    while True:
+        kwargs = {'PolicyArn': p['Arn']}
+        if marker:
+            kwargs['Marker'] = marker
+        page = call_with_backoff(myiam.list_entities_for_policy, **kwargs)
+        for key in ae:
+            ae[key] += page.get(key, [])
+        if not page.get('IsTruncated'):
+            break
+        marker = page['Marker']
+    return mypol, ae
+
+
+def file_writer(writeQueue):
+    # Writer stage: disk I/O runs here while the pool waits on IAM
     while True:
+        item = writeQueue.get()
+        if item is None:
+            return
+        fname, data = item
+        pfl = open(fname, 'w')
+        pfl.write(json.dumps(data, default=str, indent=4))
+        pfl.close()
+
+
+def collect_list(myiam, cache):
+    # One list_policies page at a time, then a version and an entities
+    # lookup per new or changed policy in the thread pool. Unchanged
+    # policies come straight from the cache.
+    global args
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+        paginator = myiam.get_paginator('list_policies')
+        passcount = 1
+        for page in paginator.paginate(OnlyAttached=True):
+            print("Policy Collection, Pass Number: {}".format(passcount))
+            passcount += 1
+            for p in page['Policies']:
+                entry = cache.get(p['Arn'])
+                if cache_fresh(entry, p):
+                    yield ({'Policy': p,
+                            'PolicyVersion': entry['PolicyVersion']},
+                           entry['entities'])
+                else:
+                    futures.append(pool.submit(fetch_policy, myiam, p,
+                                               entry))
         pbar = ProgressBar('Collecting Policies')
+        for future in pbar(futures):
+            yield future.result()
+
+
+def collect_bulk(myiam):
+    # Every policy with its versions, and every user, group and role with
+    # its attached policies, from get_account_authorization_details. The
+    # list_policies / get_policy_version / list_entities_for_policy
+    # records are rebuilt locally.
+    entities = {}
+    policies = []
+    sources = [('UserDetailList', 'PolicyUsers', 'UserName', 'UserId'),
+               ('GroupDetailList', 'PolicyGroups', 'GroupName', 'GroupId'),
+               ('RoleDetailList', 'PolicyRoles', 'RoleName', 'RoleId')]
+    paginator = myiam.get_paginator('get_account_authorization_details')
+    passcount = 1
+    for page in paginator.paginate(Filter=['User', 'Group', 'Role',
+                                           'LocalManagedPolicy',
+                                           'AWSManagedPolicy']):
         print("Policy Collection, Pass Number: {}".format(passcount))
         passcount += 1
-        if marker:
-            response_iterator = myiam.list_policies(OnlyAttached=True,
-                                                    Marker=marker)
-        else:
-            response_iterator = myiam.list_policies(OnlyAttached=True)
-        for p in pbar(response_iterator['Policies']):
-            polVers = myiam.get_policy_version(
-                PolicyArn=p['Arn'], VersionId=p['DefaultVersionId'])
-            mypol = {'Policy': p, 'PolicyVersion': polVers['PolicyVersion']}
+        for listKey, entityKey, nameKey, idKey in sources:
+            for entity in page.get(listKey, []):
+                for attached in entity.get('AttachedManagedPolicies', []):
+                    ae = entities.setdefault(attached['PolicyArn'], {
+                        'PolicyGroups': [], 'PolicyUsers': [],
+                        'PolicyRoles': []})
+                    ae[entityKey].append({nameKey: entity[nameKey],
+                                          idKey: entity[idKey]})
+        policies += page.get('Policies', [])
+    pbar = ProgressBar('Collecting Policies')
+    for p in pbar(policies):
+        if not p.get('AttachmentCount'):
+            continue
+        policy = {k: v for k, v in p.items()
+                  if k not in ['PolicyVersionList', 'Description']}
+        policy.setdefault('PolicyName', p['Arn'].split('/')[-1])
+        version = [v for v in p['PolicyVersionList']
+                   if v['VersionId'] == p['DefaultVersionId']][0]
+        mypol = {'Policy': policy, 'PolicyVersion': version}
+        yield mypol, entities.get(p['Arn'], {
+            'PolicyGroups': [], 'PolicyUsers': [], 'PolicyRoles': []})
+
+
+def get_policies(profile, folder):
+    # Collect one account's policies into folder/policies and
+    # folder/attachedentities
+    global args
+    policyDir = os.path.join(folder, 'policies')
+    entityDir = os.path.join(folder, 'attachedentities')
+    os.makedirs(policyDir, exist_ok=True)
+    os.makedirs(entityDir, exist_ok=True)
+    if profile == "default":
+        # The default credential chain, which may have no [default] profile
+        session = boto3.session.Session()
+    else:
+        session = boto3.session.Session(profile_name=profile)
+    # One client is shared by every thread in the pool
+    myiam = session.client('iam', endpoint_url=args.endpointUrl,
+                           config=Config(max_pool_connections=args.threads,
+                                         retries={'max_attempts': 10}))
+    account = session.client('sts', endpoint_url=args.endpointUrl)\
+        .get_caller_identity()['Account']
+    cache = load_policy_cache(account)
+    newCache = {}
+    allPolicies = []
+    writeQueue = queue.Queue(maxsize=1000)
+    writer = threading.Thread(target=file_writer, args=(writeQueue,))
+    writer.start()
+    if args.mode == 'bulk':
+        records = collect_bulk(myiam)
+    else:
+        records = collect_list(myiam, cache)
+    try:
+        for mypol, ae in records:
+            p = mypol['Policy']
+            name = p['PolicyName'] + '.json'
             allPolicies.append(mypol)
-            pfl = open(os.path.join('policies/', p['PolicyName']+'.json'), 'w')
-            pfl.write(json.dumps(mypol, default=str, indent=4))
-            pfl.close()
-            ae = myiam.list_entities_for_policy(PolicyArn=p['Arn'])
-            pfl = open(os.path.join('attachedentities/',
-                                    p['PolicyName']+'.json'), 'w')
-            pfl.write(json.dumps(ae, default=str, indent=4))
-            pfl.close()
-        try:
-            marker = response_iterator['Marker']
-        except KeyError:
-            break
-    print("\nTotal Policies: {}".format(len(allPolicies)))
-    pbar = ProgressBar('\tChecking for Dangerous Policies')
-    for p in pbar(allPolicies):
-        # This section looks for bad/dangerous patterns
-
-        # Pattern 1: Allow *.*
-
-        # AWSLambdaRole {
-        # 'Version': '2012-10-17',
-        # 'Statement': [
-        #   {'Effect': 'Allow',
-        #   'Action': '*',
-        #   'Resource': ['*']
-        #   }
-        # ]
-        # }
+            entry = cache.get(p['Arn'])
+            # Only new or changed policies are rewritten
+            if (entry is None or entry['key'] != cache_key(p)
+                    or entry['entities'] != ae
+                    or not os.path.exists(os.path.join(policyDir, name))):
+                writeQueue.put((os.path.join(policyDir, name), mypol))
+                writeQueue.put((os.path.join(entityDir, name), ae))
+            if args.mode == 'list' and cache_fresh(entry, p):
+                fetched = entry['fetched']
+            else:
+                fetched = time.time()
+            newCache[p['Arn']] = {'key': cache_key(p),
+                                  'PolicyName': p['PolicyName'],
+                                  'PolicyVersion': mypol['PolicyVersion'],
+                                  'entities': ae, 'fetched': fetched}
+    finally:
+        writeQueue.put(None)
+        writer.join()
+    # Evict policies that are gone or no longer attached
+    for arn in set(cache) - set(newCache):
+        name = cache[arn]['PolicyName'] + '.json'
+        logging.info("Removing stale policy: " + arn)
+        for subdir in [policyDir, entityDir]:
+            if os.path.exists(os.path.join(subdir, name)):
+                os.remove(os.path.join(subdir, name))
+    save_policy_cache(account, newCache)
+    print("\n{}: Total Policies: {}".format(profile, len(allPolicies)))
+    return allPolicies
 
-        try:
-            q = p['PolicyVersion']['Document']['Statement'][0]
-        except Exception as e:
-            print("Problem parsing this policy: {}".format(p))
-            logging.debug("Problem parsing this policy: {}".format(p))
-            print(e)
-            continue
-        try:
-            if (q['Effect'] == "Allow" and '*' in q['Resource']
-                    and '*' in q['Action']):
-                print("Review Dangerous Policy: {} -> {}".format(
-                    p['Policy']['PolicyName'],
-                    p['PolicyVersion']['Document']))
-        except Exception as e:
-            pass
-
-        # Pattern 2: Allow: *, NotAction
-
-        # {'Version': '2012-10-17',
-        # 'Statement': [
-        #   {
-        #       'Effect': 'Allow',
-        #       'NotAction': ['iam:*', 'organizations:*', 'account:*'],
-        #       'Resource': '*'
-        #   },
-        #   {
-        #       'Effect': 'Allow',
-        #       'Action': [ 'iam:CreateServiceLinkedRole',
-        #                   'iam:DeleteServiceLinkedRole',
-        #                   'iam:ListRoles',
-        #                   'organizations:DescribeOrganization',
-        #                   'account:ListRegions'
-        #                 ],
-        #       'Resource': '*'
-        #   }
-        # ]}
-        # This policy blacklists all 'iam:*', 'organizations:*', and
-        #   'accounts:*' with the NotAction. Then it grants specific
-        #   access in the next stanza ('iam:ListRoles', etc)
-        # The fatal flaw is that it grants access to everything else,
-        # like lambda or ec2 because of the "Allow" in the first stanza.
-        # This user can create an EC2 instance, attach an admin role to
-        # it, and login and give themselves access to Admin. Instance
-        # privilege escalation.
-        try:
-            if (q['NotAction'] and q['Effect'] == 'Allow'
-                    and q['Resource'] == '*'):
-                print("Review Suspect Policy: {} -> {}".format(
-                    p['Policy']['PolicyName'],
-                    p['PolicyVersion']['Document']))
-        except Exception as e:
-            pass
-    return
+
+def collect_accounts(profiles):
+    # Each account has its own session and output folder. A failing
+    # account is logged and skipped.
+    global args
+    allPolicies = []
+    single = len(profiles) == 1 and args.outputDir == '.'
+    workers = max(1, min(args.accountThreads, len(profiles)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {}
+        for profile in profiles:
+            # A single account keeps the old layout in the current folder
+            folder = '.' if single else os.path.join(args.outputDir, profile)
+            futures[pool.submit(get_policies, profile, folder)] = profile
+        for future in concurrent.futures.as_completed(futures):
+            profile = futures[future]
+            try:
+                allPolicies += [(profile, p) for p in future.result()]
+            except Exception as e:
+                print("Policy collection failed for {}: {}".format(
+                    profile, e))
+                logging.error("Policy collection failed for " + profile)
+                logging.error(e)
+    return allPolicies
+
+
+def find_profiles(pattern):
+    # Profiles in the AWS config file whose name contains pattern
+    configFile = os.path.expanduser("~/.aws/config")
+    if not os.path.exists(configFile):
+        logging.error("AWS Config file unreadable")
+        print("AWS Config file unreadable")
+        quit()
+    profiles = []
+    for x in open(configFile, 'r').read().split("\n"):
+        if "[profile" in x and pattern in x:
+            profiles.append(x.strip('[]').split(" ")[1])
+    return profiles
 
 
 def check_args_creds(args):
     # handle profiles / authentication / credentials
-    workingCreds = False
     global logging
     global workingProfiles
     workingProfiles = []
-    if not args.profile:
+    if args.regex:
+        candidates = find_profiles(args.regex)
+    elif args.profiles:
+        candidates = [p.strip() for p in args.profiles.split(',')
+                      if p.strip()]
+    elif args.profile:
+        candidates = [args.profile]
+    else:
         logging.info("Using AWS Default Profile")
-        if (not check_profile("default")):
-            logging.error("Default credentials not working.")
-            print("Default credentials not working.")
-            quit()
-        else:
-            workingProfiles.append("default")
-            workingCreds = True
-    if args.profile and args.profile is not None:
-        logging.info("Using " + args.profile + " Profile")
-        if (not check_profile(args.profile)):
-            logging.error("Profile " + args.profile + " not working")
-            exit(1)
-        else:
-            logging.info("Profile " + args.profile + " working")
-            workingProfiles.append(args.profile)
-            workingCreds = True
-    return args.profile
+        candidates = ["default"]
+    workers = max(1, min(args.accountThreads, len(candidates)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for profile, works in zip(candidates,
+                                  pool.map(check_profile, candidates)):
+            if works:
+                logging.info("Profile " + profile + " working")
+                workingProfiles.append(profile)
+            else:
+                logging.error("Profile " + profile + " not working")
+                print("Profile " + profile + " not working")
+    if not workingProfiles:
+        print("No working profiles.")
+        exit(1)
+    return workingProfiles
 
 
 def check_profile(profile):
@@ -180,8 +565,44 @@ def check_profile(profile):
 def setup_args(parser):
     parser.add_argument("-p", "--profile",
                         help="AWS Profile")
+    parser.add_argument("-P", "--profiles",
+                        help="Comma separated list of AWS Profiles")
+    parser.add_argument("-r", "--regex",
+                        help="Pattern to Identify AWS Profiles in "
+                        "~/.aws/config")
+    parser.add_argument("-o", "--outputDir", default=".",
+                        help="Output Directory. Each account is written to "
+                        "its own <outputDir>/<profile>/ folder")
+    parser.add_argument("-T", "--accountThreads", type=int, default=8,
+                        help="Accounts collected concurrently [8]")
     parser.add_argument("-l", "--log",
                         help="Log Level")
+    parser.add_argument("-t", "--threads", type=int, default=10,
+                        help="Concurrent IAM requests [10]")
+    parser.add_argument("-m", "--mode", choices=['list', 'bulk'],
+                        default='list',
+                        help="list: list_policies plus per policy lookups "
+                        "[default]. bulk: get_account_authorization_details")
+    parser.add_argument("-c", "--cacheDir", default="policycache",
+                        help="Directory for the per account policy cache "
+                        "[policycache]")
+    parser.add_argument("-f", "--refresh", action="store_true",
+                        help="Ignore the policy cache and fetch every "
+                        "policy")
+    parser.add_argument("-E", "--entityMaxAge", type=float, default=24,
+                        help="Hours the cached attached entities of an "
+                        "unchanged policy are reused before they are "
+                        "fetched again [24]")
+    parser.add_argument("-w", "--workers", type=int,
+                        default=os.cpu_count() or 1,
+                        help="Processes analyzing policies [# of CPUs]")
+    parser.add_argument("-A", "--analyzeOnly", action="store_true",
+                        help="Analyze the documents already in "
+                        "<outputDir>/policies/ and "
+                        "<outputDir>/<profile>/policies/ without calling "
+                        "AWS")
+    parser.add_argument("-e", "--endpointUrl",
+                        help="IAM endpoint URL, e.g. a local moto server")
 
 
 def main():
@@ -197,8 +618,12 @@ def main():
     logging.basicConfig(filename='policyAssessment.log',
                         format='%(levelname)s:%(message)s',
                         level=loglevel)
-    profile = check_args_creds(args)
-    get_policies(profile)
+    if args.analyzeOnly:
+        allPolicies = load_local_policies()
+    else:
+        profiles = check_args_creds(args)
+        allPolicies = collect_accounts(profiles)
+    write_report(analyze_policies(allPolicies))
 
 
 if __name__ == "__main__":
@@ -1,20 +1,115 @@
 import argparse
+import asyncio
 import boto3
+from botocore.auth import S3SigV4Auth, SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import ReadOnlyCredentials
+from botocore.httpsession import URLLib3Session
+from botocore.loaders import create_loader
+from botocore.regions import EndpointResolver
+import collections
+import concurrent.futures
+import configparser
+import contextlib
 import csv
+import hashlib
+import http.server
 import json
 import logging
 import mmap
-import numpy as np
 import os
 import pandas as pd
 import psutil
-import queue
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import random
+import re
+import shutil
+import signal
+import socket
+import sqlite3
 from shlex import quote
 import subprocess
 import sys
 import threading
 import time
 import uuid
+import xlsxwriter
+
+# Excel's sheet row limit, including the header row
+EXCEL_MAX_ROWS = 1048576
+# Rows per chunk when streaming a results CSV
+CHUNK_ROWS = 200000
+# Text columns stored dictionary encoded in the Parquet result dataset
+DICTIONARY_COLUMNS = ['PROFILE', 'REGION', 'TITLE_ID', 'RESULT', 'SCORED',
+                      'LEVEL', 'TITLE_TEXT']
+# pandas dtypes of result columns when loaded for reports. Every low
+# cardinality column is categorical, RESULT with its known vocabulary.
+FINDINGS_DTYPES = {
+    'PROFILE': 'category', 'ACCOUNT_NUM': 'category', 'REGION': 'category',
+    'TITLE_ID': 'category', 'LEVEL': 'category', 'SCORED': 'category',
+    'TITLE_TEXT': 'category', 'NOTES': str,
+    'RESULT': pd.api.types.CategoricalDtype(['PASS', 'FAIL', 'INFO',
+                                             'WARNING'])}
+# Per work unit and per stage measurements, see export_metrics()
+metrics = {'units': {}, 'stages': {}}
+# Per work unit (aggregate_results() counts, rows), filled as units finish
+unitCounts = {}
+# Set by SIGUSR1, see request_partial()
+partialRequested = False
+# Hive partitioning of the Parquet result dataset
+DATASET_PARTITIONING = ds.partitioning(
+    pa.schema([('SCAN', pa.string()), ('ACCOUNT_NUM', pa.string())]),
+    flavor='hive')
+# Assumed role credentials are renewed once they expire within this many
+# seconds. Credentials handed to a Prowler run must also outlast the run,
+# see credential_lifetime().
+CREDENTIAL_REFRESH_SECONDS = 900
+# Organization account id -> assumed role credentials, see assume_account()
+credentialCache = {}
+orgAccounts = set()
+credentialLock = threading.Lock()
+# Prowler exits 3 when checks fail, the scan itself still completed
+PROWLER_OK_EXIT_CODES = (0, 3)
+# Seconds a timed out Prowler gets to exit after SIGTERM before SIGKILL
+KILL_GRACE_SECONDS = 10
+# Manifest updates are appended to a journal, the manifest itself is
+# rewritten after this many, see update_manifest()
+MANIFEST_COMPACT_UPDATES = 1000
+manifestJournal = None
+manifestUpdates = 0
+# Running Prowler processes by pid with their usage, sampled together
+# every MONITOR_INTERVAL seconds, see monitor_processes()
+MONITOR_INTERVAL = 1
+monitoredProcesses = {}
+# A unit running this many times the median unit wall time is a straggler
+SPECULATE_FACTOR = 2
+# AWS API actions the API cache answers once per account and region, see
+# api_cacheable(). STS is never cached, it hands out credentials.
+READ_ONLY_PREFIXES = ('Describe', 'List', 'Get')
+# Request headers dropped or re-created when the API cache re-signs a
+# request
+RESIGNED_HEADERS = ['host', 'authorization', 'x-amz-date',
+                    'x-amz-security-token', 'x-amz-content-sha256',
+                    'content-length', 'connection', 'accept-encoding',
+                    'expect']
+# Response headers the API cache does not pass back
+HOP_HEADERS = ['connection', 'keep-alive', 'transfer-encoding',
+               'content-length']
+# Caching AWS API endpoint for Prowler, see start_api_cache()
+apiCacheUrl = None
+apiTokens = {}
+# Least recently used first, responses are evicted once they take more
+# than --apiCacheMB
+apiCache = collections.OrderedDict()
+apiCacheLock = threading.Lock()
+apiCacheStats = {'hits': 0, 'misses': 0, 'passedThrough': 0}
+apiCacheMemory = {'cachedBytes': 0, 'peakCachedBytes': 0, 'evictions': 0}
+# Pause of new units against a throttled (account, region), doubled for
+# every further throttled unit in a row, see throttle_key()
+KEY_BACKOFF_SECONDS = 15
+KEY_BACKOFF_MAX = 300
 
 
 def setup_args(parser):
@@ -24,24 +119,115 @@ def setup_args(parser):
                         help="Path to Prowler Executable. "
                         "Defaults to ./prowler/prowler")
     parser.add_argument("-pc", "--prowlerCheck",
-                        help="Single or List of Prowler Check(s) [check11]")
+                        help="Single or List of Prowler Check(s) [check11]. "
+                        "Each check is scanned as its own work unit")
     parser.add_argument("-pg", "--prowlerGroup",
-                        help="Group of Prowler Checks [cislevel2]")
+                        help="Single or List of Groups of Prowler Checks "
+                        "[cislevel2]. Each group is scanned as its own "
+                        "work unit")
     parser.add_argument("-pE", "--prowlerExclude",
                         help="Execute all tests except a list of specified "
                         "checks separated by comma (i.e. check21,check31)")
     parser.add_argument("-R", "--region",
-                        help="AWS Region")
+                        help="AWS Region or comma separated list of Regions. "
+                        "Each Region is scanned as its own work unit "
+                        "through Prowler's -f region filter. Defaults to "
+                        "us-east-1")
     parser.add_argument("-r", "--regex",
                         help="REGEX Pattern to Identify AWS Profiles")
     parser.add_argument("-o", "--outputDir",
                         help="Output Directory")
-    # parser.add_argument("-o", "--organization",
-    #                     help="AWS Profile for Organization Account")
+    parser.add_argument("-O", "--organization",
+                        help="AWS Profile for the Organization management "
+                        "Account. Every active member account is scanned "
+                        "through an assumed audit role")
+    parser.add_argument("-ar", "--auditRole",
+                        default="OrganizationAccountAccessRole",
+                        help="Role assumed in each Organization member "
+                        "account [OrganizationAccountAccessRole]")
+    parser.add_argument("-rd", "--roleDuration", type=int, default=3600,
+                        help="Seconds assumed role credentials are valid "
+                        "[3600]. More than 3600 needs a higher "
+                        "MaxSessionDuration on the audit role and is not "
+                        "allowed when -O itself uses assumed role "
+                        "credentials (role chaining)")
+    parser.add_argument("-e", "--endpointUrl",
+                        help="Endpoint URL for the Organizations and STS "
+                        "calls and the --apiCache upstream, e.g. a local "
+                        "AWS stand-in")
+    parser.add_argument("-ac", "--apiCache", action="store_true",
+                        help="Send Prowler's AWS API calls through a local "
+                        "endpoint that answers repeated read-only calls "
+                        "per account and region from memory. Needs an AWS "
+                        "CLI that supports AWS_ENDPOINT_URL")
+    parser.add_argument("-acm", "--apiCacheMB", type=int, default=256,
+                        help="Memory for cached API responses, least "
+                        "recently used ones are evicted beyond it [256]")
     parser.add_argument("-t", "--maxthreads", type=int,
-                        help="Max threads: defaults to # of CPUs")
+                        help="Max concurrent Prowler processes: defaults to "
+                        "4 x # of CPUs")
+    parser.add_argument("-mt", "--minthreads", type=int, default=1,
+                        help="Min concurrent Prowler processes [1]")
+    parser.add_argument("-kt", "--keythreads", type=int, default=4,
+                        help="Max concurrent Prowler processes against one "
+                        "account and region, lowered while AWS throttles "
+                        "it [4]")
+    parser.add_argument("-ut", "--unitTimeout", type=int, default=0,
+                        help="Seconds before a Prowler process and all its "
+                        "children are killed (0 disables) [0]")
+    parser.add_argument("-rt", "--retries", type=int, default=2,
+                        help="Retries of a failed or timed out work unit "
+                        "[2]")
+    parser.add_argument("-rb", "--retryBackoff", type=float, default=30,
+                        help="Seconds before the first retry, doubled for "
+                        "every further retry [30]")
+    parser.add_argument("--speculate", action="store_true",
+                        help="Once no work units are left to start, run a "
+                        "second copy of straggling units in idle slots and "
+                        "keep whichever finishes first")
+    parser.add_argument("-pi", "--partialInterval", type=int, default=0,
+                        help="Seconds between partial reports of the units "
+                        "finished so far (0 disables) [0]. SIGUSR1 writes "
+                        "one on demand. Ignored by --worker")
+    parser.add_argument("--coordinator", type=str, metavar="QUEUEDIR",
+                        help="Publish the scan's work units to a queue "
+                        "directory on shared storage for --worker "
+                        "processes, then merge and report their results")
+    parser.add_argument("--worker", type=str, metavar="QUEUEDIR",
+                        help="Run work units from a --coordinator queue "
+                        "directory until its scan is finished")
+    parser.add_argument("-lt", "--leaseTimeout", type=int, default=120,
+                        help="Seconds without a renewal before a worker's "
+                        "work unit is given to another worker [120]")
+    parser.add_argument("--max-age", dest="maxAge", type=int, default=0,
+                        help="Reuse a work unit's results from the result "
+                        "cache when they are at most this many seconds "
+                        "old, and cache new results (0 disables) [0]")
+    parser.add_argument("--force", action="store_true",
+                        help="Rescan every work unit even when --max-age "
+                        "finds fresh cached results, and refresh the cache")
     parser.add_argument("-F", "--resultsFile", type=str,
-                        help="Results CSV to process to a report XLSX file")
+                        help="Results CSV or Parquet results dataset "
+                        "directory to process to a report XLSX file")
+    parser.add_argument("-S", "--scanId", type=str,
+                        help="Scan UUID to report on when -F is a Parquet "
+                        "results dataset")
+    parser.add_argument("-ct", "--profileCacheTTL", type=int, default=3600,
+                        help="Seconds a validated profile stays in the "
+                        "profile cache (0 disables the cache) [3600]")
+    parser.add_argument("-vt", "--validationThreads", type=int, default=16,
+                        help="Profiles validated concurrently [16]")
+    parser.add_argument("--resume", type=str, metavar="SCANUUID",
+                        help="Resume an interrupted scan from its manifest "
+                        "in the output directory")
+    parser.add_argument("-D", "--findingsDb", type=str,
+                        help="SQLite findings database. Defaults to "
+                        "findings.db in the output directory")
+    parser.add_argument("--diff", type=str, nargs=2,
+                        metavar=("SCANA", "SCANB"),
+                        help="Report new, fixed and still failing findings "
+                        "per account between two scans in the findings "
+                        "database")
     parser.add_argument("-l", "--log", type=str,
                         choices=['info', 'INFO', 'debug', 'DEBUG'],
                         help="Set LogLevel to INFO (Default) or DEBUG")
@@ -96,12 +282,12 @@ def check_args_creds(args):
     global verbose
     global workingProfiles
     workingProfiles = []
-    if not args.profile and not args.regex:
+    if not args.profile and not args.regex and not args.organization:
         logging.info("Using AWS Default Profile")
         if verbose:
             print("Using AWS Default Profile")
             print(args.profile)
-        if (not check_profile("default")):
+        if (not validate_profiles(["default"])[0][1]):
             logging.error("Default credentials not working.")
             print("Default credentials not working.")
             quit()
@@ -112,7 +298,7 @@ def check_args_creds(args):
         logging.info("Using " + args.profile + " Profile")
         if verbose:
             print("Using " + args.profile + " Profile")
-        if (not check_profile(args.profile)):
+        if (not validate_profiles([args.profile])[0][1]):
             logging.error("Profile " + args.profile + " not working")
             if verbose:
                 print("Profile " + args.profile + " not working")
@@ -148,23 +334,23 @@ def check_args_regex(args):
             logging.info("REGEX found")
             if verbose:
                 print("REGEX found")
+            candidates = []
             for x in configFileContent.split("\n"):
                 if "[profile" in x and args.regex in x:
                     profileCount += 1
                     thisProfile = x.strip('[]').split(" ")[1]
-                    logging.debug("Checking profile: " + thisProfile)
+                    candidates.append(thisProfile)
+            for thisProfile, works in validate_profiles(candidates):
+                if works:
+                    logging.debug("Profile " + thisProfile + " works.")
+                    if verbose:
+                        print("Profile " + thisProfile + " works.")
+                    workingProfiles.append(thisProfile)
+                else:
+                    logging.debug("Profile " + thisProfile
+                                  + " does not work.")
                     if verbose:
-                        print("Checking profile: " + thisProfile)
-                    if (check_profile(thisProfile)):
-                        logging.debug("Profile " + thisProfile + " works.")
-                        if verbose:
-                            print("Profile " + thisProfile + " works.")
-                        workingProfiles.append(thisProfile)
-                    else:
-                        logging.debug("Profile " + thisProfile
-                                      + " does not work.")
-                        if verbose:
-                            print("Profile " + thisProfile + " does not work.")
+                        print("Profile " + thisProfile + " does not work.")
 
             if (profileCount > 1) or (profileCount == 0):
                 profresp = (str(profileCount) + " Profiles found. "
@@ -197,15 +383,24 @@ def check_args_outputDir(args):
 
 
 def process_args(args):
+    global workingProfiles
     check_args_outputDir(args)
     check_args_debug(args)
     check_args_verbosity(args)
-    check_args_prowlerPath(args)
-    check_args_creds(args)
-    check_args_regex(args)
+    # A coordinator never runs Prowler, a worker gets its profiles from
+    # the coordinator's work units
+    if not args.coordinator:
+        check_args_prowlerPath(args)
+    if args.worker:
+        workingProfiles = []
+    else:
+        check_args_creds(args)
+        check_args_regex(args)
+    check_args_organizations(args)
 
 
 def check_profile(profile):
+    # A single cheap identity call proves the credentials work
     global logging
     try:
         if(profile == "default"):
@@ -218,185 +413,2013 @@ def check_profile(profile):
         logging.error(e)
         return False
     try:
-        iam = client.client('iam')
-        response = iam.list_users()
+        sts = client.client('sts')
+        response = sts.get_caller_identity()
     except Exception as e:
-        logging.error("Error listing users: ")
+        logging.error("Error getting caller identity: ")
         logging.error(e)
         return False
-    if len(response['Users']) == 0:
-        logging.info("No users")
-    if len(response) > 0:
-        usercnt = len(response['Users'])
-        if(usercnt > 1):
-            userresp = " Users"
-        else:
-            userresp = " User"
-        logging.info(str(usercnt) + userresp)
+    logging.info(profile + " is " + response['Arn'])
     return True
 
 
-def run_prowler(x):
+def profile_fingerprint(profile):
+    # Hash of everything in the AWS config / credentials files that
+    # decides which credentials a profile resolves to
+    sections = []
+    config = configparser.RawConfigParser()
+    config.read([os.path.expanduser("~/.aws/config"),
+                 os.path.expanduser("~/.aws/credentials")])
+    names = [profile]
+    while names:
+        name = names.pop(0)
+        for section in [name, 'profile ' + name]:
+            if config.has_section(section):
+                items = sorted(config.items(section))
+                sections.append((section, items))
+                source = dict(items).get('source_profile')
+                if source and source not in names and source != name:
+                    names.append(source)
+    return hashlib.sha256(json.dumps(sections).encode()).hexdigest()
+
+
+def load_profile_cache():
+    fname = os.path.expanduser('~/.parallel_prowler/profile_cache.json')
+    if not os.path.exists(fname):
+        return {}
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Unreadable profile cache: " + fname)
+        logging.error(e)
+        return {}
+
+
+def save_profile_cache(cache):
+    fname = os.path.expanduser('~/.parallel_prowler/profile_cache.json')
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+
+def validate_profiles(profiles):
+    # Check profiles concurrently. Working profiles are cached by name and
+    # credential fingerprint, so reruns within the TTL skip the AWS call.
+    global args
+    global logging
+    ttl = args.profileCacheTTL
+    cache = load_profile_cache() if ttl > 0 else {}
+    now = time.time()
+    results = {}
+    pending = {}
+    for profile in profiles:
+        fingerprint = profile_fingerprint(profile)
+        entry = cache.get(profile)
+        if (entry and entry['fingerprint'] == fingerprint
+                and now - entry['validated'] < ttl):
+            logging.debug("Profile " + profile + " found in profile cache")
+            results[profile] = True
+        else:
+            pending[profile] = fingerprint
+    maxWorkers = max(1, min(args.validationThreads, len(pending)))
+    with concurrent.futures.ThreadPoolExecutor(maxWorkers) as pool:
+        futures = {pool.submit(check_profile, p): p for p in pending}
+        for future in concurrent.futures.as_completed(futures):
+            profile = futures[future]
+            results[profile] = future.result()
+            if results[profile]:
+                cache[profile] = {'fingerprint': pending[profile],
+                                  'validated': now}
+            else:
+                cache.pop(profile, None)
+    if ttl > 0 and pending:
+        save_profile_cache(cache)
+    return [(p, results[p]) for p in profiles]
+
+
+def list_org_accounts(session):
+    # Active member accounts of the Organization
+    global args
+    client = session.client('organizations', endpoint_url=args.endpointUrl)
+    accounts = []
+    for page in client.get_paginator('list_accounts').paginate():
+        accounts += [a['Id'] for a in page['Accounts']
+                     if a['Status'] == 'ACTIVE']
+    return accounts
+
+
+def assume_account(accountId, validFor=CREDENTIAL_REFRESH_SECONDS):
+    # Credentials for the audit role in an Organization account. They are
+    # cached and only renewed when they expire within validFor seconds,
+    # all calls share the management account's STS client.
+    global args
+    global credentialCache
+    global credentialLock
+    global stsClient
+    with credentialLock:
+        creds = credentialCache.get(accountId)
+    if (creds and creds['Expiration'].timestamp() - time.time()
+            > validFor):
+        return creds
+    logging.info("Assuming " + args.auditRole + " in " + accountId)
+    response = stsClient.assume_role(
+        RoleArn='arn:aws:iam::' + accountId + ':role/' + args.auditRole,
+        RoleSessionName='parallel-prowler',
+        DurationSeconds=args.roleDuration)
+    creds = response['Credentials']
+    with credentialLock:
+        credentialCache[accountId] = creds
+    return creds
+
+
+def check_args_organizations(args):
+    # Handle Organizations and use it to create list of accounts to audit
+    global logging
+    global orgAccounts
+    global stsClient
+    global verbose
+    global workingProfiles
+    orgAccounts = set()
+    if not args.organization:
+        logging.info("No AWS Organization Account")
+        if verbose:
+            print("No AWS Organization Account")
+        return
+    if (not validate_profiles([args.organization])[0][1]):
+        logging.error("Profile " + args.organization + " not working")
+        print("Profile " + args.organization + " not working")
+        quit()
+    if args.organization == "default":
+        session = boto3.session.Session()
+    else:
+        session = boto3.session.Session(profile_name=args.organization)
+    try:
+        accounts = list_org_accounts(session)
+    except Exception as e:
+        logging.error("Error listing Organization accounts: ")
+        logging.error(e)
+        print("Error listing Organization accounts: " + str(e))
+        quit()
+    stsClient = session.client('sts', endpoint_url=args.endpointUrl)
+    maxWorkers = max(1, min(args.validationThreads, len(accounts)))
+    with concurrent.futures.ThreadPoolExecutor(maxWorkers) as pool:
+        futures = {pool.submit(assume_account, a): a for a in accounts}
+        for future in concurrent.futures.as_completed(futures):
+            accountId = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logging.error("Cannot assume " + args.auditRole + " in "
+                              + accountId + ": ")
+                logging.error(e)
+                if verbose:
+                    print("Account " + accountId + " does not work.")
+                continue
+            orgAccounts.add(accountId)
+    # Keep the Organization's account order
+    for accountId in accounts:
+        if accountId in orgAccounts:
+            workingProfiles.append(accountId)
+    profresp = (str(len(accounts)) + " Organization Accounts found. "
+                + str(len(orgAccounts)) + " Accounts work.")
+    print(profresp)
+    logging.info(profresp)
+    if not orgAccounts:
+        logging.error("No working Organization accounts")
+        quit()
+
+
+def credential_lifetime(unit):
+    # Seconds the credentials a Prowler run starts with must stay valid:
+    # --unitTimeout, else twice the unit's duration in an earlier scan.
+    # Units never timed get credentials as fresh as --roleDuration allows.
+    global args
+    global durationDict
+    expected = args.unitTimeout or 2 * durationDict.get(unit_key(unit), 0)
+    if not expected:
+        return max(CREDENTIAL_REFRESH_SECONDS,
+                   args.roleDuration - CREDENTIAL_REFRESH_SECONDS)
+    if expected + CREDENTIAL_REFRESH_SECONDS > args.roleDuration:
+        logging.warning(unit_key(unit) + ": may run longer than the "
+                        + str(args.roleDuration) + "s --roleDuration "
+                        "credentials")
+    return expected + CREDENTIAL_REFRESH_SECONDS
+
+
+def prowler_env(unit):
+    # Organization accounts hand their assumed role credentials to Prowler
+    # through the environment, named profiles use the inherited one. With
+    # the API cache every AWS call goes to its per-account path.
+    global apiCacheUrl
+    global orgAccounts
+    if unit['profile'] not in orgAccounts and not apiCacheUrl:
+        return None
+    env = dict(os.environ)
+    if unit['profile'] in orgAccounts:
+        creds = assume_account(unit['profile'], credential_lifetime(unit))
+        env.pop('AWS_PROFILE', None)
+        env['AWS_ACCESS_KEY_ID'] = creds['AccessKeyId']
+        env['AWS_SECRET_ACCESS_KEY'] = creds['SecretAccessKey']
+        env['AWS_SESSION_TOKEN'] = creds['SessionToken']
+    if apiCacheUrl:
+        env['AWS_ENDPOINT_URL'] = apiCacheUrl + '/'\
+            + api_cache_token(unit['profile'])
+    return env
+
+
+def api_cache_token(profile):
+    # Random path prefix that tells the API cache which account's
+    # credentials to sign with
+    global apiCacheLock
+    global apiTokens
+    with apiCacheLock:
+        for token, p in apiTokens.items():
+            if p == profile:
+                return token
+        token = uuid.uuid4().hex
+        apiTokens[token] = profile
+        return token
+
+
+def api_credentials(profile):
+    global apiSessions
+    if profile in orgAccounts:
+        creds = assume_account(profile)
+        return ReadOnlyCredentials(creds['AccessKeyId'],
+                                   creds['SecretAccessKey'],
+                                   creds['SessionToken'])
+    with apiCacheLock:
+        if profile not in apiSessions:
+            if profile == "default":
+                apiSessions[profile] = boto3.session.Session()
+            else:
+                apiSessions[profile] = boto3.session.Session(
+                    profile_name=profile)
+        session = apiSessions[profile]
+    return session.get_credentials().get_frozen_credentials()
+
+
+def api_cacheable(method, service, action):
+    if service == 'sts':
+        return False
+    if action:
+        return action.startswith(READ_ONLY_PREFIXES)
+    # REST APIs without an action name
+    return method in ['GET', 'HEAD']
+
+
+def api_forward(profile, method, path, headers, body, service, region):
+    # Re-sign a Prowler request with the account's credentials and send it
+    # to the real AWS endpoint for its service and region
+    global apiEndpoints
+    global apiHttp
+    global args
+    if args.endpointUrl:
+        url = args.endpointUrl.rstrip('/') + path
+    else:
+        endpoint = apiEndpoints.construct_endpoint(service, region)
+        if endpoint:
+            url = 'https://' + endpoint['hostname'] + path
+        else:
+            url = 'https://' + service + '.' + region + '.amazonaws.com'\
+                + path
+    request = AWSRequest(method=method, url=url, data=body, headers={
+        k: v for k, v in headers.items()
+        if k.lower() not in RESIGNED_HEADERS})
+    signer = S3SigV4Auth if service == 's3' else SigV4Auth
+    signer(api_credentials(profile), service, region).add_auth(request)
+    response = apiHttp.send(request.prepare())
+    return (response.status_code,
+            [(k, v) for k, v in response.headers.items()
+             if k.lower() not in HOP_HEADERS],
+            response.content)
+
+
+def api_cache_request(method, path, headers, body):
+    # Answer one Prowler request. Identical read-only requests for the same
+    # account are sent to AWS once, concurrent ones wait for that call.
+    global apiCache
+    global apiCacheLock
+    global apiCacheStats
+    global apiTokens
+    parts = path.split('/', 2)
+    profile = apiTokens.get(parts[1]) if len(parts) > 1 else None
+    if profile is None:
+        return 403, [], b''
+    path = '/' + (parts[2] if len(parts) > 2 else '')
+    # Service and region come from the SigV4 credential scope
+    scope = re.search(r'Credential=[^/]+/[^/]+/([^/]+)/([^/]+)/',
+                      headers.get('Authorization', ''))
+    if scope is None:
+        return 403, [], b''
+    region, service = scope.groups()
+    action = headers.get('X-Amz-Target', '').split('.')[-1]
+    if not action:
+        match = re.search(r'(?:^|[?&])Action=([A-Za-z0-9]+)',
+                          path + '&' + body.decode('utf-8', 'replace'))
+        action = match.group(1) if match else ''
+    if not api_cacheable(method, service, action):
+        with apiCacheLock:
+            apiCacheStats['passedThrough'] += 1
+        return api_forward(profile, method, path, headers, body, service,
+                           region)
+    key = hashlib.sha256(json.dumps(
+        [profile, region, service, method, path,
+         headers.get('X-Amz-Target', ''),
+         hashlib.sha256(body).hexdigest()]).encode()).hexdigest()
+    with apiCacheLock:
+        entry = apiCache.get(key)
+        owner = entry is None
+        if owner:
+            entry = {'done': threading.Event(), 'response': None, 'size': 0}
+            apiCache[key] = entry
+        else:
+            apiCache.move_to_end(key)
+    if not owner:
+        entry['done'].wait()
+        if entry['response'] is not None:
+            with apiCacheLock:
+                apiCacheStats['hits'] += 1
+            return entry['response']
+        # The first call failed, errors are never cached
+        return api_forward(profile, method, path, headers, body, service,
+                           region)
+    response = None
+    try:
+        response = api_forward(profile, method, path, headers, body,
+                               service, region)
+    finally:
+        with apiCacheLock:
+            apiCacheStats['misses'] += 1
+            if response is not None and 200 <= response[0] < 300:
+                entry['response'] = response
+                entry['size'] = len(response[2]) + sum(
+                    len(k) + len(v) for k, v in response[1])
+                apiCacheMemory['cachedBytes'] += entry['size']
+                evict_api_cache()
+            else:
+                apiCache.pop(key, None)
+        entry['done'].set()
+    return response
+
+
+def evict_api_cache():
+    # Drop least recently used responses until the cache fits in
+    # --apiCacheMB. Calls still in flight are skipped, their waiters keep
+    # the response they get. Called with apiCacheLock held.
+    global apiCache
+    global apiCacheMemory
+    global args
+    limit = args.apiCacheMB * 1024 * 1024
+    for key in list(apiCache):
+        if apiCacheMemory['cachedBytes'] <= limit:
+            break
+        if apiCache[key]['response'] is None:
+            continue
+        apiCacheMemory['cachedBytes'] -= apiCache.pop(key)['size']
+        apiCacheMemory['evictions'] += 1
+    apiCacheMemory['peakCachedBytes'] = max(
+        apiCacheMemory['peakCachedBytes'], apiCacheMemory['cachedBytes'])
+
+
+class ApiCacheHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+            status, headers, data = api_cache_request(
+                self.command, self.path, self.headers, body)
+        except Exception as e:
+            logging.error("API cache request failed: ")
+            logging.error(e)
+            status, headers, data = 502, [], str(e).encode()
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_request
+
+    def log_message(self, format, *args):
+        logging.debug("API cache: " + format % args)
+
+
+def start_api_cache():
+    # Local endpoint the Prowler children reach through AWS_ENDPOINT_URL,
+    # it lives as long as the scan
+    global apiCacheUrl
+    global apiEndpoints
+    global apiHttp
+    global apiServer
+    global apiSessions
+    apiEndpoints = EndpointResolver(create_loader().load_data('endpoints'))
+    apiHttp = URLLib3Session()
+    apiSessions = {}
+    apiServer = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                ApiCacheHandler)
+    apiServer.daemon_threads = True
+    threading.Thread(target=apiServer.serve_forever, daemon=True).start()
+    apiCacheUrl = 'http://127.0.0.1:' + str(apiServer.server_address[1])
+    logging.info("API cache: " + apiCacheUrl)
+
+
+def stop_api_cache():
+    global apiCacheMemory
+    global apiCacheStats
+    global apiCacheUrl
+    global apiServer
+    global metrics
+    apiServer.shutdown()
+    apiServer.server_close()
+    apiCacheUrl = None
+    metrics['apiCache'] = dict(apiCacheStats)
+    metrics['apiCacheMemory'] = dict(apiCacheMemory)
+    logging.info("API cache: " + str(apiCacheStats['hits']) + " hits, "
+                 + str(apiCacheStats['misses']) + " misses, "
+                 + str(apiCacheStats['passedThrough'])
+                 + " passed through, "
+                 + str(apiCacheMemory['peakCachedBytes'])
+                 + " bytes at peak, "
+                 + str(apiCacheMemory['evictions']) + " evictions")
+
+
+def unit_key(unit):
+    # Stable name for a work unit, used for output files and durations
+    return '-'.join([unit['profile'], unit['region'],
+                     unit['check'] or unit['group'] or 'all'])
+
+
+def build_units(profiles):
+    # Split every profile into work units by region and by check / group
     global args
+    if args.region:
+        regions = [r.strip() for r in args.region.split(',') if r.strip()]
+    else:
+        regions = ['us-east-1']
+    shards = []
+    if args.prowlerCheck:
+        shards += [(c.strip(), None) for c in args.prowlerCheck.split(',')
+                   if c.strip()]
+    if args.prowlerGroup:
+        shards += [(None, g.strip()) for g in args.prowlerGroup.split(',')
+                   if g.strip()]
+    if not shards:
+        shards = [(None, None)]
+    units = []
+    for profile in profiles:
+        for region in regions:
+            for check, group in shards:
+                units.append({'profile': profile, 'region': region,
+                              'check': check, 'group': group})
+    return units
+
+
+def load_durations():
+    # Durations (seconds) of work units from earlier scans
+    global outputDir
+    fname = outputDir + '/unit-durations.json'
+    if not os.path.exists(fname):
+        return {}
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Unreadable durations file: " + fname)
+        logging.error(e)
+        return {}
+
+
+def save_durations(durations):
+    global outputDir
+    fname = outputDir + '/unit-durations.json'
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(durations, f, indent=4, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+
+def order_units(units, durations):
+    # Longest job first. Units never seen before are scheduled first
+    # because nothing is known about how long they take.
+    return sorted(units, key=lambda u: -durations.get(unit_key(u),
+                                                      float('inf')))
+
+
+def manifest_name(uuidStr):
+    global outputDir
+    return outputDir + '/scan-' + str(uuidStr) + '-manifest.json'
+
+
+def journal_name(uuidStr):
+    # One [unit key, changed fields] JSON line per update since the
+    # manifest was last written
+    global outputDir
+    return outputDir + '/scan-' + str(uuidStr) + '-manifest.journal'
+
+
+def file_checksum(fname):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def save_manifest():
+    # Written to a temp file and renamed, so a crash never leaves a
+    # truncated manifest behind. The journal is emptied afterwards, a
+    # crash in between only replays updates the manifest already has.
+    global manifest
+    global manifestJournal
+    global manifestLock
+    global manifestUpdates
+    with manifestLock:
+        fname = manifest_name(manifest['scanUUID'])
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(fname + '.tmp', fname)
+        if manifestJournal is not None:
+            manifestJournal.close()
+        manifestJournal = open(journal_name(manifest['scanUUID']), 'w')
+        manifestUpdates = 0
+
+
+def journal_manifest(x, fields):
+    global manifestJournal
+    global manifestUpdates
+    manifestJournal.write(json.dumps([x, fields]) + '\n')
+    manifestJournal.flush()
+    manifestUpdates += 1
+    if manifestUpdates >= MANIFEST_COMPACT_UPDATES:
+        save_manifest()
+
+
+def update_manifest(x, **fields):
+    # Cheap enough for the event loop: one appended line, the whole
+    # manifest only every MANIFEST_COMPACT_UPDATES updates
+    global manifest
+    global manifestLock
+    with manifestLock:
+        manifest['units'][x].update(fields)
+        journal_manifest(x, fields)
+
+
+def new_manifest(units):
+    global manifest
+    global manifestLock
+    global scanTime
+    global scanUUID
+    global manifestJournal
+    manifestLock = threading.RLock()
+    manifestJournal = None
+    manifest = {'scanUUID': str(scanUUID), 'scanTime': scanTime,
+                'units': {}}
+    for unit in units:
+        add_manifest_unit(unit)
+    save_manifest()
+
+
+def add_manifest_unit(unit):
+    global manifest
+    global manifestJournal
+    global manifestLock
+    with manifestLock:
+        manifest['units'][unit_key(unit)] = {
+            'unit': unit, 'state': 'pending', 'exitCode': None,
+            'file': None, 'sha256': None}
+        if manifestJournal is not None:
+            # Units a worker claims after the manifest was written
+            journal_manifest(unit_key(unit),
+                             manifest['units'][unit_key(unit)])
+
+
+def load_manifest(uuidStr):
+    # Restore scanUUID / scanTime and reset every unit that did not
+    # finish with an intact output file back to pending
     global logging
+    global manifest
+    global manifestJournal
+    global manifestLock
+    global scanTime
+    global scanUUID
+    fname = manifest_name(uuidStr)
+    if not os.path.exists(fname):
+        print("Scan manifest not found: " + fname)
+        logging.error("Scan manifest not found: " + fname)
+        quit()
+    manifestLock = threading.RLock()
+    manifestJournal = None
+    with open(fname, 'r') as f:
+        manifest = json.load(f)
+    if os.path.exists(journal_name(uuidStr)):
+        with open(journal_name(uuidStr), 'r') as f:
+            for line in f:
+                try:
+                    x, fields = json.loads(line)
+                except ValueError:
+                    # The last line of a crashed scan may be cut short
+                    break
+                manifest['units'].setdefault(x, {}).update(fields)
+    scanUUID = uuid.UUID(manifest['scanUUID'])
+    scanTime = manifest['scanTime']
+    for x, entry in manifest['units'].items():
+        if entry['state'] == 'done':
+            if (entry['file'] and os.path.exists(entry['file'])
+                    and file_checksum(entry['file']) == entry['sha256']):
+                continue
+            logging.info("Output missing or changed, rescanning: " + x)
+        entry['state'] = 'pending'
+    save_manifest()
+    return [entry['unit'] for entry in manifest['units'].values()]
+
+
+def unit_file(x):
+    # Output file name of a work unit, without extension
     global outputDir
+    global scanTime
+    global scanUUID
+    return outputDir + '/prowler-' + str(int(scanTime)) + '-'\
+        + str(scanUUID) + '-' + quote(x)
+
+
+def link_or_copy(src, dst):
+    # Output files are never changed once written, so a hard link is as
+    # good as a copy
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def prowler_version():
+    # Version and, for a git checkout, commit of the Prowler in use. Both
+    # are part of every result cache key.
+    global logging
     global prowlerPath
+    path = os.path.realpath(prowlerPath)
+    version = ''
+    commit = ''
+    try:
+        version = subprocess.run(
+            [path, '-V'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            timeout=60).stdout.decode(errors='replace').strip()
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.error("Cannot get the Prowler version: ")
+        logging.error(e)
+    try:
+        commit = subprocess.run(
+            ['git', '-C', os.path.dirname(path), 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            timeout=60).stdout.decode(errors='replace').strip()
+    except (OSError, subprocess.SubprocessError):
+        pass
+    logging.info("Prowler version: " + version + " " + commit)
+    return version + ' ' + commit
+
+
+def result_cache_key(unit):
+    # Results are reusable for the same account, Prowler options (region,
+    # checks, excludes) and Prowler release
+    global prowlerRelease
+    parts = ([unit['profile']] + build_prowler_cmd(unit)[1:]
+             + [prowlerRelease])
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def cache_unit_result(unit, fname, unitMetrics):
+    # Keep a successful unit's output in the result cache. The metadata is
+    # written last, so a half stored entry is never used.
+    global outputDir
+    cacheDir = outputDir + '/result-cache'
+    os.makedirs(cacheDir, exist_ok=True)
+    base = os.path.join(cacheDir, result_cache_key(unit))
+    for ext in ['.csv', '.log']:
+        link_or_copy(fname + ext, base + ext + '.tmp')
+        os.replace(base + ext + '.tmp', base + ext)
+    with open(base + '.json.tmp', 'w') as f:
+        json.dump({'unit': unit, 'cachedAt': time.time(),
+                   'metrics': unitMetrics}, f, indent=4)
+    os.replace(base + '.json.tmp', base + '.json')
+
+
+def serve_cached_units(units):
+    # Put fresh cached results in place of Prowler runs. Returns the
+    # units that still have to be scanned.
+    global args
+    global logging
+    global metrics
+    global outputDir
     global resultDict
+    global unitCounts
+    cacheDir = outputDir + '/result-cache'
+    todo = []
+    for unit in units:
+        x = unit_key(unit)
+        base = os.path.join(cacheDir, result_cache_key(unit))
+        entry = None
+        if os.path.exists(base + '.json'):
+            try:
+                with open(base + '.json', 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error("Unreadable result cache entry: " + base)
+                logging.error(e)
+        if entry is None or time.time() - entry['cachedAt'] > args.maxAge:
+            todo.append(unit)
+            continue
+        fname = unit_file(x)
+        for ext in ['.csv', '.log']:
+            link_or_copy(base + ext, fname + ext)
+        update_manifest(x, state='done',
+                        exitCode=entry['metrics']['exitCode'],
+                        file=fname + '.csv',
+                        sha256=file_checksum(fname + '.csv'), cached=True)
+        resultDict[x] = fname + '.csv'
+        metrics['units'][x] = dict(entry['metrics'], cached=True)
+        unitCounts[x] = aggregate_file(fname + '.csv')
+        logging.info(x + ": served from the result cache, "
+                     + str(int(time.time() - entry['cachedAt']))
+                     + "s old")
+    print(str(len(units) - len(todo)) + " of " + str(len(units))
+          + " work units served from the result cache")
+    return todo
+
+
+def build_prowler_cmd(unit):
+    global args
+    global orgAccounts
+    global prowlerPath
+    cmd = [os.path.realpath(prowlerPath)]
+    if unit['profile'] not in orgAccounts:
+        cmd += ['-p', unit['profile']]
+    # -r is only the region API calls are sent to, Prowler runs its
+    # regional checks in every region unless -f filters them
+    cmd += ['-r', unit['region'], '-f', unit['region']]
+    if args.prowlerExclude:
+        cmd += ['-E', args.prowlerExclude]
+    cmd += ['-n']
+    cmd += ['-b', '-M', 'csv']
+    if unit['check'] is not None:
+        cmd += ['-c', unit['check']]
+    if unit['group'] is not None:
+        cmd += ['-g', unit['group']]
+    return cmd
+
+
+def check_throttled(fname):
+    # Look for AWS throttling errors in a unit's output
+    signatures = [b'Throttling', b'RequestLimitExceeded',
+                  b'TooManyRequestsException', b'Rate exceeded']
+    with open(fname, 'rb') as f:
+        for line in f:
+            for sig in signatures:
+                if sig in line:
+                    return True
+    return False
+
+
+def unit_throttled(fname):
+    # Throttling shows up in Prowler's stderr and in the NOTES of rows
+    return any(os.path.exists(f) and check_throttled(f)
+               for f in [fname + '.log', fname + '.csv'])
+
+
+def unit_endpoint(unit):
+    # Units against the same account and region share its API rate limits
+    return (unit['profile'], unit['region'])
+
+
+def key_state(key):
+    global args
+    global keyState
+    if key not in keyState:
+        keyState[key] = {'limit': max(1, args.keythreads), 'running': 0,
+                         'backoffUntil': 0, 'strikes': 0}
+    return keyState[key]
+
+
+def key_has_slot(key):
+    state = key_state(key)
+    return (state['running'] < state['limit']
+            and time.time() >= state['backoffUntil'])
+
+
+def throttle_key(key):
+    # Halve the slots of a throttled account / region and pause it
+    global logging
+    state = key_state(key)
+    state['strikes'] += 1
+    state['limit'] = max(1, state['limit'] // 2)
+    pause = min(KEY_BACKOFF_MAX,
+                KEY_BACKOFF_SECONDS * 2 ** (state['strikes'] - 1))
+    state['backoffUntil'] = time.time() + pause
+    logging.info("Throttled: " + '/'.join(key) + ", limit "
+                 + str(state['limit']) + ", paused "
+                 + str(pause) + "s")
+
+
+def recover_key(key):
+    # A clean run gives a throttled account / region one slot back
+    global args
+    state = key_state(key)
+    state['strikes'] = 0
+    state['limit'] = min(max(1, args.keythreads), state['limit'] + 1)
+
+
+@contextlib.contextmanager
+def stage_timer(name):
+    global metrics
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics['stages'][name] = time.time() - start
+        logging.info("Stage " + name + ": "
+                     + str(round(metrics['stages'][name], 3)) + "s")
+
+
+def sample_processes(roots):
+    # One pass over the process table for all running Prowlers: the
+    # parent -> children map is built once and each tree summed from it.
+    # CPU is the root's own and reaped-children time plus that of live
+    # descendants, RSS is the largest sum over the tree.
+    children = {}
+    for proc in psutil.process_iter(['ppid']):
+        children.setdefault(proc.info['ppid'], []).append(proc)
+    for pid, usage in roots:
+        try:
+            root = psutil.Process(pid)
+            cpu = root.cpu_times()
+            total = cpu.user + cpu.system + cpu.children_user\
+                + cpu.children_system
+            rss = root.memory_info().rss
+        except psutil.Error:
+            continue
+        stack = list(children.get(pid, []))
+        while stack:
+            child = stack.pop()
+            stack += children.get(child.pid, [])
+            try:
+                childCpu = child.cpu_times()
+                total += childCpu.user + childCpu.system
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        usage['cpuSeconds'] = max(usage['cpuSeconds'], total)
+        usage['peakRssBytes'] = max(usage['peakRssBytes'], rss)
+
+
+async def monitor_processes():
+    # Runs for the whole scan, the sampling itself is kept off the loop
+    global monitoredProcesses
+    loop = asyncio.get_event_loop()
+    while True:
+        if monitoredProcesses:
+            await loop.run_in_executor(None, sample_processes,
+                                       list(monitoredProcesses.items()))
+        await asyncio.sleep(MONITOR_INTERVAL)
+
+
+async def stop_process(p):
+    # Prowler runs in its own session, so the whole process group (the
+    # shell script and every AWS CLI call under it) is terminated
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(p.wait(), KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await p.wait()
+
+
+async def exec_prowler(cmd, env, fname, usage):
+    # One Prowler run. Returns exit code, result rows and whether the
+    # unit timeout expired.
+    global args
+    global monitoredProcesses
+    # stdout goes block by block to the per-account CSV and stderr straight
+    # to a per-account log, so nothing is held in memory and no line is
+    # too long
+    f = open(fname + '.csv', 'wb')
+    errlog = open(fname + '.log', 'wb')
+    p = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=errlog, env=env,
+        start_new_session=True)
+    monitoredProcesses[p.pid] = usage
+    counter = {'lines': 0, 'headers': 0, 'last': b'\n'}
+
+    async def consume():
+        # Header lines are counted across block boundaries by keeping the
+        # end of the previous block
+        tail = b''
+        while True:
+            block = await p.stdout.read(1024 * 1024)
+            if not block:
+                break
+            f.write(block)
+            counter['lines'] += block.count(b'\n')
+            counter['headers'] += (tail + block).count(b'ACCOUNT_NUM')
+            tail = block[-(len(b'ACCOUNT_NUM') - 1):]
+            counter['last'] = block[-1:]
+        await p.wait()
+    timedOut = False
+    try:
+        await asyncio.wait_for(consume(), args.unitTimeout or None)
+    except asyncio.TimeoutError:
+        timedOut = True
+        await stop_process(p)
+    except BaseException:
+        # Cancelled because a speculative copy of this unit finished first,
+        # or the output could not be written
+        await stop_process(p)
+        raise
+    finally:
+        monitoredProcesses.pop(p.pid, None)
+        f.close()
+        errlog.close()
+    rows = counter['lines'] - counter['headers']
+    if counter['last'] != b'\n':
+        rows += 1
+    return p.returncode, rows, timedOut
+
+
+async def run_prowler(unit, speculative=False):
+    global args
+    global claimedUnits
+    global durationDict
+    global logging
+    global metrics
+    global outputDir
+    global queuedAt
+    global resultDict
+    global unitCounts
+    global unitTasks
     global verbose
+    x = unit_key(unit)
+    endpoint = unit_endpoint(unit)
     logging.debug("Inside run_prowler: " + x)
     if verbose:
         print("Inside run_prowler: " + x)
-    cmd = os.path.realpath(prowlerPath)
-    cmdopts = ' -p {}'.format(quote(x))
-    if args.region:
-        cmdopts += ' -r {}'.format(quote(args.Region))
-    else:
-        cmdopts += ' -r us-east-1'
-    if args.prowlerExclude:
-        cmdopts += ' -E {}'.format(quote(args.prowlerExclude))
-    cmdopts += ' -n'
-    cmdopts += ' -b -M csv'
-    if args.prowlerCheck is not None:
-        cmdopts += ' -c {}'.format(quote(args.prowlerCheck))
-    if args.prowlerGroup is not None:
-        cmdopts += ' -g {}'.format(quote(args.prowlerGroup))
-    logging.info(cmd+cmdopts)
+    cmd = build_prowler_cmd(unit)
+    logging.info(' '.join(quote(c) for c in cmd))
     if verbose:
-        print(cmd+cmdopts)
-    p = subprocess.run([cmd + cmdopts], shell=True, text=True, check=False,
-                       capture_output=True)
+        print(' '.join(quote(c) for c in cmd))
+    fname = unit_file(x)
+    if speculative:
+        fname += '-speculative'
+    loop = asyncio.get_event_loop()
+    # A speculative copy gets a single attempt, the original retries
+    # failures with exponential backoff
+    attempts = 1 if speculative else 1 + max(0, args.retries)
+    throttledAttempts = 0
+    for attempt in range(attempts):
+        if attempt:
+            delay = args.retryBackoff * 2 ** (attempt - 1)\
+                * random.uniform(0.5, 1.5)
+            delay = max(delay, key_state(endpoint)['backoffUntil']
+                        - time.time())
+            logging.info(x + ": retry " + str(attempt) + " in "
+                         + str(round(delay, 1)) + "s")
+            await asyncio.sleep(delay)
+            # The account / region slot is given up between attempts
+            while not key_has_slot(endpoint):
+                await asyncio.sleep(1)
+        key_state(endpoint)['running'] += 1
+        startTime = time.time()
+        usage = {'cpuSeconds': 0.0, 'peakRssBytes': 0}
+        try:
+            update_manifest(x, state='running', attempts=attempt + 1)
+            env = await loop.run_in_executor(None, prowler_env, unit)
+            returnCode, rows, timedOut = await exec_prowler(cmd, env, fname,
+                                                            usage)
+        except Exception as e:
+            # Credentials or output errors are a failed attempt, retried
+            # like a failed Prowler run
+            logging.error(x + ": attempt " + str(attempt + 1) + " failed: ")
+            logging.error(e)
+            returnCode, rows, timedOut = None, 0, False
+        finally:
+            key_state(endpoint)['running'] -= 1
+        throttled = await loop.run_in_executor(None, unit_throttled, fname)
+        if throttled:
+            throttledAttempts += 1
+            throttle_key(endpoint)
+        else:
+            recover_key(endpoint)
+        if timedOut:
+            logging.error(x + ": timed out after "
+                          + str(args.unitTimeout) + "s, process group "
+                          "killed")
+        elif returnCode in PROWLER_OK_EXIT_CODES:
+            # Throttled checks report wrong results, so they are rescanned
+            # while retries are left
+            if not throttled or attempt + 1 == attempts:
+                break
+            logging.info(x + ": AWS throttling errors in " + fname
+                         + ".log / .csv, rescanning")
+    if x in claimedUnits:
+        # Another copy of this unit already finished
+        return
+    if returnCode not in PROWLER_OK_EXIT_CODES and any(
+            not task.done() for task in unitTasks.get(x, [])
+            if task is not asyncio.current_task()):
+        # The copy still running may yet succeed, it records the unit
+        logging.info(x + (": speculative copy" if speculative else ":")
+                     + " failed, exit code " + str(returnCode)
+                     + ", left to the other copy")
+        return
+    claimedUnits.add(x)
+    if returnCode in PROWLER_OK_EXIT_CODES:
+        for task in unitTasks.get(x, []):
+            if task is not asyncio.current_task():
+                task.cancel()
+    if speculative:
+        logging.info(x + ": speculative copy finished "
+                     + ("first" if returnCode in PROWLER_OK_EXIT_CODES
+                        else "last, both copies failed"))
+    durationDict[x] = time.time() - startTime
+    metrics['units'][x] = {
+        'profile': unit['profile'], 'region': unit['region'],
+        'check': unit['check'] or unit['group'] or 'all',
+        'queueWaitSeconds': startTime - queuedAt.get(x, startTime),
+        'wallSeconds': durationDict[x], 'cpuSeconds': usage['cpuSeconds'],
+        'peakRssBytes': usage['peakRssBytes'], 'exitCode': returnCode,
+        'rows': rows, 'attempts': attempt + 1,
+        'throttledAttempts': throttledAttempts}
     logging.debug("Inside run_prowler - subprocess: ")
-    logging.info(p)
+    logging.info(x + ": exit code " + str(returnCode) + ", "
+                 + str(rows) + " rows in " + str(round(durationDict[x], 1))
+                 + "s, stderr in " + fname + ".log")
     if verbose:
         print("Inside run_prowler - subprocess")
-        print(p)
-    resultDict[x] = p.stdout
-    fname = 'prowler-' + str(int(scanTime)) + '-' + str(scanUUID)\
-        + '-' + quote(x) + '.csv'
-    fname = outputDir + '/' + fname
-    f = open(fname, 'w')
-    f.write(p.stdout)
-    f.close()
+        print(x + ": exit code " + str(returnCode) + ", "
+              + str(rows) + " rows")
+    if not os.path.exists(fname + '.csv'):
+        # Every attempt failed before Prowler started
+        update_manifest(x, state='failed', exitCode=returnCode)
+        if args.worker:
+            await loop.run_in_executor(None, publish_unit, args.worker, x)
+        return
+    sha256 = await loop.run_in_executor(None, file_checksum, fname + '.csv')
+    update_manifest(x, state='done' if returnCode in PROWLER_OK_EXIT_CODES
+                    else 'failed',
+                    exitCode=returnCode, file=fname + '.csv',
+                    sha256=sha256)
+    # Only the file name is kept, merge_results() reads the output back
+    resultDict[x] = fname + '.csv'
+    if (args.maxAge > 0 and returnCode in PROWLER_OK_EXIT_CODES
+            and not throttled and not args.worker):
+        await loop.run_in_executor(None, cache_unit_result, unit, fname,
+                                   metrics['units'][x])
+    if args.worker:
+        await loop.run_in_executor(None, publish_unit, args.worker, x)
+        return
+    # Counted now, so the report needs no aggregation pass at the end
+    unitCounts[x] = await loop.run_in_executor(None, aggregate_file,
+                                               fname + '.csv')
 
 
-def worker():
+def adjust_concurrency(limit, minLimit, maxLimit):
+    # Raise the number of Prowler processes while the host has CPU and
+    # memory headroom, lower it under pressure. AWS throttling is handled
+    # per account and region, see throttle_key().
     global logging
-    global q
+    cpu = psutil.cpu_percent(interval=None)
+    mem = psutil.virtual_memory().percent
+    if cpu > 85 or mem > 85:
+        newLimit = max(minLimit, limit - 1)
+    elif cpu < 60 and mem < 75:
+        newLimit = min(maxLimit, limit + 1)
+    else:
+        newLimit = limit
+    if newLimit != limit:
+        logging.info("Concurrency " + str(limit) + " -> " + str(newLimit)
+                     + " (CPU " + str(cpu) + "%, memory " + str(mem) + "%)")
+    return newLimit
+
+
+def pick_straggler(running, startedAt, finishedWalls):
+    # The longest running unit, once it has run for SPECULATE_FACTOR times
+    # the median wall time of the units finished so far
+    global speculated
+    if not finishedWalls:
+        return None
+    median = sorted(finishedWalls)[len(finishedWalls) // 2]
+    candidates = [x for x in running if x not in speculated]
+    if not candidates:
+        return None
+    x = min(candidates, key=lambda c: startedAt[c])
+    if time.time() - startedAt[x] < SPECULATE_FACTOR * median:
+        return None
+    return x
+
+
+async def run_scan(units, minLimit, maxLimit):
+    # Run work units in order, keeping at most `limit` Prowler processes
+    # alive and at most the key limit against any one account and region.
+    # The limit is re-evaluated every few seconds.
+    global args
+    global claimedUnits
+    global keyState
+    global logging
+    global metrics
+    global partialRequested
+    global queuedAt
+    global speculated
+    global unitTasks
+    claimedUnits = set()
+    keyState = {}
+    speculated = set()
+    unitTasks = {}
+    taskKeys = {}
+    pending = list(units)
+    now = time.time()
+    queuedAt = {unit_key(u): now for u in units}
+    byKey = {unit_key(u): u for u in units}
+    startedAt = {}
+    tasks = set()
+    limit = max(minLimit, min(maxLimit, psutil.cpu_count(logical=False)
+                              or 1))
+    psutil.cpu_percent(interval=None)
+    lastAdjust = time.time()
+    loop = asyncio.get_event_loop()
+    monitor = asyncio.ensure_future(monitor_processes())
+    partial = {'last': time.time(), 'future': None}
+    lastRenew = time.time()
+    while pending or tasks or (args.worker
+                               and not queue_finished(args.worker)):
+        while len(tasks) < limit:
+            # The first unit in LJF order whose account / region has a
+            # free slot and is not paused
+            unit = next((u for u in pending
+                         if key_has_slot(unit_endpoint(u))), None)
+            if unit is None and args.worker and len(pending) < limit:
+                # Workers take their next unit from the shared queue
+                unit = claim_unit(args.worker)
+                if unit is not None:
+                    logging.info("Claimed work unit: " + unit_key(unit))
+                    add_manifest_unit(unit)
+                    queuedAt[unit_key(unit)] = time.time()
+                    byKey[unit_key(unit)] = unit
+                    pending.append(unit)
+                    continue
+            if unit is None:
+                break
+            pending.remove(unit)
+            task = asyncio.ensure_future(run_prowler(unit))
+            unitTasks[unit_key(unit)] = [task]
+            taskKeys[task] = unit_key(unit)
+            startedAt[unit_key(unit)] = time.time()
+            tasks.add(task)
+            # Let the unit take its account / region slot before the next
+            # one is picked
+            await asyncio.sleep(0)
+        if args.speculate and not pending and len(tasks) < limit:
+            # Idle slots at the end of the scan run a copy of the slowest
+            # unit, whichever copy finishes first is kept
+            x = pick_straggler(
+                [k for k in unitTasks if k not in claimedUnits
+                 and key_has_slot(unit_endpoint(byKey[k]))], startedAt,
+                [metrics['units'][k]['wallSeconds'] for k in claimedUnits
+                 if k in metrics['units']])
+            if x is not None:
+                logging.info(x + ": starting speculative copy")
+                speculated.add(x)
+                task = asyncio.ensure_future(
+                    run_prowler(byKey[x], speculative=True))
+                unitTasks[x].append(task)
+                taskKeys[task] = x
+                tasks.add(task)
+        if args.worker and time.time() - lastRenew >= args.leaseTimeout / 4:
+            # Only units still queued or running here, a unit whose tasks
+            # ended is published or left to expire
+            renew_leases(args.worker,
+                         [unit_key(u) for u in pending]
+                         + [k for k, ts in unitTasks.items()
+                            if not all(t.done() for t in ts)])
+            lastRenew = time.time()
+        if not tasks:
+            # Everything left waits for a throttled account / region
+            await asyncio.sleep(1)
+            continue
+        done, tasks = await asyncio.wait(
+            tasks, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                logging.error("Work unit failed: ")
+                logging.error(task.exception())
+                x = taskKeys[task]
+                if args.worker and all(t.done() for t in unitTasks[x]):
+                    # Published without output, or the coordinator would
+                    # re-issue the unit again and again
+                    update_manifest(x, state='failed', file=None)
+                    await loop.run_in_executor(None, publish_unit,
+                                               args.worker, x)
+        if time.time() - lastAdjust >= 5:
+            limit = adjust_concurrency(limit, minLimit, maxLimit)
+            lastAdjust = time.time()
+        # Workers leave partial reports to the coordinator
+        if not args.worker and (partialRequested or (
+                args.partialInterval and time.time() - partial['last']
+                >= args.partialInterval)) and (
+                partial['future'] is None or partial['future'].done()):
+            partialRequested = False
+            partial['last'] = time.time()
+            partial['future'] = loop.run_in_executor(
+                None, write_partial_report, list(unitCounts.values()))
+    monitor.cancel()
+    if partial['future'] is not None:
+        await partial['future']
+
+
+def queue_dirs(queueDir):
+    # pending/ holds unclaimed units in LJF order, leases/ the units a
+    # worker is running, done/ one record per finished unit and results/
+    # the uploaded output of every unit
+    return {name: os.path.join(queueDir, name)
+            for name in ['pending', 'leases', 'done', 'results']}
+
+
+def queue_finished(queueDir):
+    return os.path.exists(os.path.join(queueDir, 'finished'))
+
+
+def publish_units(queueDir, units):
+    # Coordinator: describe the scan and queue every unit not yet done
+    global args
+    global scanTime
+    global scanUUID
+    dirs = queue_dirs(queueDir)
+    fname = os.path.join(queueDir, 'scan.json')
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            if json.load(f)['scanUUID'] != str(scanUUID):
+                # The queue held another scan, its units are dropped
+                logging.info("Clearing old scan from " + queueDir)
+                for d in dirs.values():
+                    shutil.rmtree(d, ignore_errors=True)
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    if queue_finished(queueDir):
+        os.remove(os.path.join(queueDir, 'finished'))
+    with open(fname + '.tmp', 'w') as f:
+        json.dump({'scanUUID': str(scanUUID), 'scanTime': scanTime,
+                   'prowlerExclude': args.prowlerExclude}, f, indent=4)
+    os.replace(fname + '.tmp', fname)
+    for i, unit in enumerate(units):
+        x = unit_key(unit)
+        if (os.path.exists(os.path.join(dirs['done'], x + '.json'))
+                or os.path.exists(os.path.join(dirs['leases'],
+                                               x + '.json'))):
+            continue
+        fname = os.path.join(dirs['pending'],
+                             '{:06d}-{}.json'.format(i + 1, x))
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(unit, f)
+        os.replace(fname + '.tmp', fname)
+    logging.info("Published " + str(len(units)) + " work units to "
+                 + queueDir)
+
+
+def claim_unit(queueDir):
+    # Worker: a rename from pending/ to leases/ is atomic, so only one
+    # worker gets each unit
+    dirs = queue_dirs(queueDir)
+    for name in sorted(os.listdir(dirs['pending'])):
+        if not name.endswith('.json'):
+            continue
+        lease = os.path.join(dirs['leases'], name.split('-', 1)[1])
+        try:
+            os.rename(os.path.join(dirs['pending'], name), lease)
+        except FileNotFoundError:
+            # Another worker was faster
+            continue
+        os.utime(lease)
+        with open(lease, 'r') as f:
+            return json.load(f)
+    return None
+
+
+def renew_leases(queueDir, keys):
+    dirs = queue_dirs(queueDir)
+    for x in keys:
+        try:
+            os.utime(os.path.join(dirs['leases'], x + '.json'))
+        except FileNotFoundError:
+            # Re-issued by the coordinator, the first result is kept
+            pass
+
+
+def publish_unit(queueDir, x):
+    # Worker: upload a finished unit's output and metrics. The done record
+    # is hard linked into place, so a unit run twice after a re-issued
+    # lease keeps its first result.
+    global manifest
+    global metrics
+    global workerId
+    dirs = queue_dirs(queueDir)
+    entry = manifest['units'][x]
+    base = x + '.' + workerId
+    if entry.get('file'):
+        shutil.copyfile(entry['file'], os.path.join(dirs['results'],
+                                                    base + '.csv'))
+        shutil.copyfile(entry['file'][:-len('.csv')] + '.log',
+                        os.path.join(dirs['results'], base + '.log'))
+    else:
+        # Failed before Prowler wrote any output
+        base = None
+    record = {'unit': entry['unit'], 'worker': workerId,
+              'state': entry['state'], 'exitCode': entry.get('exitCode'),
+              'file': base, 'metrics': metrics['units'].get(x)}
+    tmp = os.path.join(dirs['done'], x + '.' + workerId + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(record, f, indent=4)
+    try:
+        os.link(tmp, os.path.join(dirs['done'], x + '.json'))
+    except FileExistsError:
+        logging.info(x + ": already finished by another worker")
+    os.remove(tmp)
+    try:
+        os.remove(os.path.join(dirs['leases'], x + '.json'))
+    except FileNotFoundError:
+        pass
+
+
+def collect_units(queueDir, units):
+    # Coordinator: wait for the done record of every unit, re-issuing the
+    # leases of workers that stopped renewing them
+    global args
+    global durationDict
+    global metrics
+    global outputDir
+    global partialRequested
     global resultDict
-    global verbose
-    while True:
-        x = q.get()
-        if x is None:  # EOF?
-            return
-        else:
-            logging.debug("Inside worker: " + x)
-            if verbose:
-                print("Inside worker: " + x)
-        run_prowler(x)
+    global scanTime
+    global scanUUID
+    global unitCounts
+    dirs = queue_dirs(queueDir)
+    todo = set(unit_key(u) for u in units)
+    lastPartial = time.time()
+    while todo:
+        for x in sorted(todo):
+            fname = os.path.join(dirs['done'], x + '.json')
+            if not os.path.exists(fname):
+                continue
+            with open(fname, 'r') as f:
+                record = json.load(f)
+            todo.discard(x)
+            if record['file'] is None:
+                update_manifest(x, state='failed',
+                                exitCode=record['exitCode'],
+                                worker=record['worker'])
+                logging.error(x + ": failed on " + record['worker'])
+                continue
+            local = unit_file(x)
+            for ext in ['.csv', '.log']:
+                shutil.copyfile(os.path.join(dirs['results'],
+                                             record['file'] + ext),
+                                local + ext)
+            update_manifest(x, state=record['state'],
+                            exitCode=record['exitCode'],
+                            file=local + '.csv',
+                            sha256=file_checksum(local + '.csv'),
+                            worker=record['worker'])
+            resultDict[x] = local + '.csv'
+            durationDict[x] = record['metrics']['wallSeconds']
+            metrics['units'][x] = dict(record['metrics'],
+                                       worker=record['worker'])
+            unitCounts[x] = aggregate_file(local + '.csv')
+            logging.info(x + ": collected from " + record['worker'] + ", "
+                         + str(len(todo)) + " work units left")
+        now = time.time()
+        for name in os.listdir(dirs['leases']):
+            lease = os.path.join(dirs['leases'], name)
+            try:
+                age = now - os.path.getmtime(lease)
+            except FileNotFoundError:
+                continue
+            x = name[:-len('.json')]
+            if (age > args.leaseTimeout and x in todo and not
+                    os.path.exists(os.path.join(dirs['done'], name))):
+                # Re-issued units go to the front of the queue
+                logging.info("Lease expired, re-issuing: " + x)
+                try:
+                    os.rename(lease, os.path.join(dirs['pending'],
+                                                  '000000-' + name))
+                except FileNotFoundError:
+                    pass
+        if partialRequested or (args.partialInterval and now - lastPartial
+                                >= args.partialInterval):
+            partialRequested = False
+            write_partial_report(list(unitCounts.values()))
+            lastPartial = now
+        if todo:
+            time.sleep(2)
+    open(os.path.join(queueDir, 'finished'), 'w').close()
 
 
-def check_args_organizations(args):
+def run_worker(queueDir):
+    # Run work units from a coordinator's queue until its scan finishes
+    global args
+    global durationDict
+    global outputDir
+    global resultDict
+    global scanTime
+    global scanUUID
+    global unitCounts
+    global workerId
+    scanFile = os.path.join(queueDir, 'scan.json')
+    while not os.path.exists(scanFile):
+        logging.info("Waiting for a scan in " + queueDir)
+        time.sleep(5)
+    with open(scanFile, 'r') as f:
+        scan = json.load(f)
+    scanUUID = uuid.UUID(scan['scanUUID'])
+    scanTime = scan['scanTime']
+    args.prowlerExclude = scan['prowlerExclude']
+    workerId = socket.gethostname() + '-' + str(os.getpid())
+    # The worker's manifest, metrics and Prowler output would otherwise
+    # overwrite the coordinator's when both use the same -o
+    outputDir = os.path.join(outputDir, 'worker-' + workerId)
+    os.makedirs(outputDir, exist_ok=True)
+    print("Worker " + workerId + " on scan " + str(scanUUID))
+    logging.info("Worker " + workerId + " on scan " + str(scanUUID))
+    resultDict = {}
+    unitCounts = {}
+    durationDict = {}
+    new_manifest([])
+    minthreads, maxthreads = thread_limits()
+    with stage_timer('scan'):
+        if args.apiCache:
+            start_api_cache()
+        asyncio.run(run_scan([], minthreads, maxthreads))
+        if args.apiCache:
+            stop_api_cache()
+    save_manifest()
+    print("Worker " + workerId + " ran " + str(len(resultDict))
+          + " work units")
+    export_metrics()
+
+
+def thread_limits():
+    global args
+    if args.maxthreads and args.maxthreads > 0:
+        maxthreads = int(args.maxthreads)
+    else:
+        maxthreads = 4 * (psutil.cpu_count(logical=True) or 1)
+    minthreads = max(1, min(args.minthreads, maxthreads))
+    return minthreads, maxthreads
+
+
+def export_metrics():
+    # JSON metrics plus a Prometheus textfile collector file
+    global metrics
+    global outputDir
+    global scanTime
+    global scanUUID
+    fname = outputDir + '/metrics-' + str(int(scanTime)) + '-'\
+        + str(scanUUID) + '.json'
+    with open(fname, 'w') as f:
+        json.dump(dict(metrics, scanUUID=str(scanUUID),
+                       scanTime=scanTime), f, indent=4)
+    lines = []
+
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+    if 'apiCache' in metrics:
+        lines.append('# HELP parallel_prowler_api_cache_requests '
+                     'Prowler AWS API calls seen by the API cache')
+        lines.append('# TYPE parallel_prowler_api_cache_requests gauge')
+        for outcome, count in sorted(metrics['apiCache'].items()):
+            lines.append('parallel_prowler_api_cache_requests{{outcome="{}"}}'
+                         ' {}'.format(label(outcome), count))
+    if 'apiCacheMemory' in metrics:
+        memory = metrics['apiCacheMemory']
+        lines.append('# HELP parallel_prowler_api_cache_bytes '
+                     'Bytes of API responses held by the API cache')
+        lines.append('# TYPE parallel_prowler_api_cache_bytes gauge')
+        for kind, key in [('cached', 'cachedBytes'),
+                          ('peak', 'peakCachedBytes')]:
+            lines.append('parallel_prowler_api_cache_bytes{{kind="{}"}} {}'
+                         .format(kind, memory[key]))
+        lines.append('# HELP parallel_prowler_api_cache_evictions '
+                     'API responses evicted to stay within --apiCacheMB')
+        lines.append('# TYPE parallel_prowler_api_cache_evictions gauge')
+        lines.append('parallel_prowler_api_cache_evictions '
+                     + str(memory['evictions']))
+    lines.append('# HELP parallel_prowler_stage_seconds '
+                 'Wall time of each pipeline stage')
+    lines.append('# TYPE parallel_prowler_stage_seconds gauge')
+    for name, seconds in sorted(metrics['stages'].items()):
+        lines.append('parallel_prowler_stage_seconds{{stage="{}"}} {}'.format(
+            label(name), seconds))
+    unitMetrics = [
+        ('queueWaitSeconds', 'queue_wait_seconds',
+         'Seconds a work unit waited before Prowler started'),
+        ('wallSeconds', 'wall_seconds', 'Wall time of the Prowler run'),
+        ('cpuSeconds', 'cpu_seconds', 'CPU time of the Prowler process tree'),
+        ('peakRssBytes', 'peak_rss_bytes',
+         'Peak RSS of the Prowler process tree'),
+        ('exitCode', 'exit_code', 'Exit code of the Prowler run'),
+        ('rows', 'rows', 'Result rows written by the Prowler run'),
+        ('attempts', 'attempts', 'Prowler runs of the unit, including '
+         'retries'),
+        ('throttledAttempts', 'throttled_attempts',
+         'Prowler runs of the unit that hit AWS throttling')]
+    for key, name, helpText in unitMetrics:
+        lines.append('# HELP parallel_prowler_unit_' + name + ' ' + helpText)
+        lines.append('# TYPE parallel_prowler_unit_' + name + ' gauge')
+        for unit in sorted(metrics['units'].values(),
+                           key=lambda u: (u['profile'], u['region'],
+                                          u['check'])):
+            if unit[key] is None:
+                continue
+            lines.append('parallel_prowler_unit_{}{{profile="{}",'
+                         'region="{}",check="{}"}} {}'.format(
+                             name, label(unit['profile']),
+                             label(unit['region']), label(unit['check']),
+                             unit[key]))
+    prom = outputDir + '/parallel_prowler.prom'
+    with open(prom + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(prom + '.tmp', prom)
+    print("Metrics File: " + fname)
+
+
+def merge_results(resultFileName, fileNames):
+    # Stream each per-account CSV once into the combined results file.
+    # Only the first header line is kept, every later line containing
+    # ACCOUNT_NUM is a duplicate header and is dropped.
     global logging
-    pass
-    # # Handle Organizations and use it to create list of accounts to audit
-    # if not args.organization:
-    #     logging.info("No AWS Organization Account")
-    #     if verbose:
-    #         print("No AWS Organization Account")
-    # else:
-    #     print("Not implemented yet")
+    global verbose
+    header = False
+    print("Opening CSV")
+    resultFile = open(resultFileName, 'w', buffering=1024 * 1024)
+    for fname in fileNames:
+        if verbose:
+            print("Merging: " + fname)
+        logging.debug("Merging: " + fname)
+        if not os.path.exists(fname):
+            logging.error("Missing Prowler output: " + fname)
+            continue
+        with open(fname, 'r', buffering=1024 * 1024) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if 'ACCOUNT_NUM' in line:
+                    if header:
+                        continue
+                    print("Writing Headers")
+                    header = True
+                if not line.endswith('\n'):
+                    line += '\n'
+                resultFile.write(line)
+    resultFile.close()
+    return resultFileName
 
 
 def get_col_widths(dataframe, index):
-    # First we find the maximum length of the index column
+    # Max string length per column (and the index), including the header
+    def width(values, name):
+        lengths = pd.Series(values).astype(str).str.len()
+        return int(max(lengths.max() if len(lengths) else 0, len(str(name))))
+    widths = [width(dataframe[col].values, col) for col in dataframe.columns]
     if index:
-        idx_max = max([len(str(s)) for s in dataframe.index.values]
-                      + [len(str(dataframe.index.name))])
-        return [idx_max] + [max([len(str(s)) for s in dataframe[col].values]
-                                + [len(col)]) for col in dataframe.columns]
+        return [width(dataframe.index.values, dataframe.index.name)] + widths
+    return widths
+
+
+def aggregate_results(p_df):
+    # One groupby over PASS / FAIL rows. Every report sheet is derived
+    # from these counts.
+    keys = ['TITLE_ID', 'LEVEL', 'SCORED', 'TITLE_TEXT',
+            'PROFILE', 'ACCOUNT_NUM', 'RESULT']
+    p_df = p_df.loc[p_df['RESULT'].isin(['PASS', 'FAIL']), keys].copy()
+    for col in keys:
+        if (isinstance(p_df[col].dtype, pd.api.types.CategoricalDtype)
+                and '' not in p_df[col].cat.categories):
+            p_df[col] = p_df[col].cat.add_categories([''])
+    counts = p_df.fillna('').groupby(keys, observed=True).size()
+    # Plain values in the index, the categories differ between chunks
+    counts.index = pd.MultiIndex.from_arrays(
+        [counts.index.get_level_values(k).astype(object) for k in keys],
+        names=keys)
+    return counts.sort_index()
+
+
+def combine_counts(parts):
+    # Add up aggregate_results() counts from several chunks
+    parts = [p for p in parts if p is not None and len(p)]
+    if not parts:
+        keys = ['TITLE_ID', 'LEVEL', 'SCORED', 'TITLE_TEXT',
+                'PROFILE', 'ACCOUNT_NUM', 'RESULT']
+        return pd.Series([], dtype='int64', index=pd.MultiIndex.from_arrays(
+            [[]] * len(keys), names=keys))
+    counts = pd.concat(parts)
+    return counts.groupby(level=list(range(counts.index.nlevels))).sum()
+
+
+def aggregate_file(fname):
+    # aggregate_results() counts and row count of one unit's results CSV
+    parts = []
+    rowCount = 0
+    keys = ['TITLE_ID', 'LEVEL', 'SCORED', 'TITLE_TEXT',
+            'PROFILE', 'ACCOUNT_NUM', 'RESULT']
+    try:
+        for chunk in iter_result_chunks(fname, keys):
+            rowCount += len(chunk)
+            parts.append(aggregate_results(chunk))
+    except ValueError as e:
+        logging.error("Cannot aggregate " + fname + ": ")
+        logging.error(e)
+    return combine_counts(parts), rowCount
+
+
+def build_report_sheets(counts):
+    # Summary and pivot sheets, in workbook order, from aggregate_results()
+    accounts = ['PROFILE', 'ACCOUNT_NUM']
+    levels = counts.index.get_level_values('LEVEL')
+    cis = counts[(levels == 'Level 1') | (levels == 'Level 2')]
+    summary = cis.groupby(accounts + ['RESULT']).sum()
+    summary.name = 'RESULT'
+    sheets = [('Summary', summary)]
+    for result, label in [('PASS', 'Passing'), ('FAIL', 'Failing')]:
+        subset = counts[counts.index.get_level_values('RESULT') == result]
+        subset = subset.droplevel('RESULT')
+        sheets.append(('All ' + label, subset.groupby(
+            ['TITLE_ID', 'TITLE_TEXT'] + accounts).sum().unstack(
+            accounts, fill_value=0)))
+    for result, label in [('PASS', 'Passing'), ('FAIL', 'Failing')]:
+        subset = cis[cis.index.get_level_values('RESULT') == result]
+        subset = subset.droplevel('RESULT')
+        sheets.append(('CIS Benchmarks ' + label,
+                       subset.unstack(accounts, fill_value=0)))
+    return sheets
+
+
+def write_sheet(workbook, name, data):
+    # Write a Series / DataFrame row by row, as constant_memory requires.
+    # Column index levels become header rows above the data.
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    worksheet = workbook.add_worksheet(name)
+    indexNames = [n or '' for n in data.index.names]
+    row = 0
+    if data.columns.nlevels > 1:
+        for level in range(data.columns.nlevels):
+            worksheet.write_row(
+                row, 0, [''] * (len(indexNames) - 1)
+                + [data.columns.names[level] or '']
+                + [str(c) for c in data.columns.get_level_values(level)])
+            row += 1
+        worksheet.write_row(row, 0, indexNames)
+    else:
+        worksheet.write_row(row, 0, indexNames
+                            + [str(c) for c in data.columns])
+    row += 1
+    for idx, values in zip(data.index.tolist(), data.values.tolist()):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        worksheet.write_row(row, 0, list(idx) + values)
+        row += 1
+    return worksheet
+
+
+def write_summary(workbook, summary):
+    worksheet = write_sheet(workbook, 'Summary', summary)
+    summaryWidths = get_col_widths(
+        summary.rename('COUNT').reset_index(), False)
+    for i, width in enumerate(summaryWidths):
+        worksheet.set_column(i, i, width)
+
+
+def request_partial(signum, frame):
+    # SIGUSR1 handler, the scan loop writes the report on its next pass
+    global partialRequested
+    partialRequested = True
+
+
+def write_partial_report(parts):
+    # Summary and pivots of the units finished so far. Written to a temp
+    # file and renamed, so readers never see a half written workbook.
+    global outputDir
+    global scanTime
+    global scanUUID
+    counts = combine_counts([c for c, rows in parts])
+    rowCount = sum(rows for c, rows in parts)
+    sheets = build_report_sheets(counts)
+    excelName = outputDir + '/results-' + str(int(scanTime)) + '-'\
+        + str(scanUUID) + '-partial.xlsx'
+    workbook = xlsxwriter.Workbook(excelName + '.tmp',
+                                   {'constant_memory': True})
+    write_summary(workbook, sheets[0][1])
+    for name, sheet in sheets[1:]:
+        write_sheet(workbook, name, sheet)
+    workbook.close()
+    os.replace(excelName + '.tmp', excelName)
+    logging.info("Partial report: " + str(len(parts)) + " units, "
+                 + str(rowCount) + " rows in " + excelName)
+    print("Partial Report Excel File: " + excelName)
+
+
+def write_raw_results(workbook, rows):
+    # Stream raw result rows into RawResults, rolling over into
+    # RawResults_2, RawResults_3, ... at Excel's row limit
+    header = next(rows, None)
+    if header is None:
+        return
+    sheetNum = 0
+    worksheet = None
+    widths = []
+    row = EXCEL_MAX_ROWS
+    for values in rows:
+        if row >= EXCEL_MAX_ROWS:
+            if worksheet is not None:
+                for i, width in enumerate(widths):
+                    worksheet.set_column(i, i, width)
+            sheetNum += 1
+            name = 'RawResults'
+            if sheetNum > 1:
+                name += '_' + str(sheetNum)
+            worksheet = workbook.add_worksheet(name)
+            worksheet.write_row(0, 0, header)
+            widths = [len(h) for h in header]
+            row = 1
+        worksheet.write_row(row, 0, values)
+        for i, value in enumerate(values[:len(widths)]):
+            if len(value) > widths[i]:
+                widths[i] = len(value)
+        row += 1
+    if worksheet is None:
+        worksheet = workbook.add_worksheet('RawResults')
+        worksheet.write_row(0, 0, header)
+        widths = [len(h) for h in header]
+    for i, width in enumerate(widths):
+        worksheet.set_column(i, i, width)
+
+
+def write_result_dataset(resultFileName, datasetDir, scanId):
+    # Copy a results CSV into the Parquet dataset, partitioned by scan and
+    # account, replacing anything already stored for this scan
+    global logging
+    scanDir = os.path.join(datasetDir, 'SCAN=' + str(scanId))
+    if os.path.exists(scanDir):
+        shutil.rmtree(scanDir)
+    part = 0
+    for chunk in pd.read_csv(resultFileName, chunksize=CHUNK_ROWS, dtype=str,
+                             keep_default_na=False):
+        chunk['SCAN'] = str(scanId)
+        dictCols = [c for c in DICTIONARY_COLUMNS if c in chunk.columns]
+        for col in dictCols:
+            chunk[col] = chunk[col].astype('category')
+        pq.write_to_dataset(
+            pa.Table.from_pandas(chunk, preserve_index=False), datasetDir,
+            partition_cols=['SCAN', 'ACCOUNT_NUM'],
+            basename_template='part-' + str(part) + '-{i}.parquet',
+            use_dictionary=dictCols)
+        part += 1
+    logging.info("Results dataset: " + scanDir)
+    return scanDir
+
+
+def open_result_dataset(datasetDir, scanId):
+    # Returns the dataset and the partition filter for one scan
+    dataset = ds.dataset(datasetDir, format='parquet',
+                         partitioning=DATASET_PARTITIONING)
+    if scanId is None:
+        scans = sorted(d[len('SCAN='):] for d in os.listdir(datasetDir)
+                       if d.startswith('SCAN='))
+        if len(scans) != 1:
+            print("Choose a scan with -S, --scanId: " + ', '.join(scans))
+            quit()
+        scanId = scans[0]
+    return dataset, ds.field('SCAN') == str(scanId)
+
+
+def iter_result_chunks(source, columns):
+    # DataFrame chunks with only `columns`, typed as FINDINGS_DTYPES, from
+    # a results CSV or from one scan of a Parquet results dataset. Every
+    # report path loads results through here.
+    global args
+    dtypes = {c: FINDINGS_DTYPES.get(c, str) for c in columns}
+    if os.path.isdir(source):
+        dataset, scanFilter = open_result_dataset(source, args.scanId)
+        for batch in dataset.to_batches(columns=columns, filter=scanFilter,
+                                        batch_size=CHUNK_ROWS):
+            yield batch.to_pandas().astype(dtypes)
     else:
-        # Then, we concatenate this to the max of the lengths of column name
-        # and its values for each column, left to right
-        return [max([len(str(s)) for s in dataframe[col].values]
-                    + [len(col)]) for col in dataframe.columns]
+        for chunk in pd.read_csv(source, usecols=columns,
+                                 chunksize=CHUNK_ROWS, dtype=dtypes):
+            yield chunk
 
 
-def process_results(resultFileName):
+def read_result_rows(source):
+    # Header then raw result rows as lists of strings
+    global args
+    if os.path.isdir(source):
+        dataset, scanFilter = open_result_dataset(source, args.scanId)
+        columns = [c for c in dataset.schema.names
+                   if c not in ['SCAN', 'ACCOUNT_NUM']]
+        columns.insert(1, 'ACCOUNT_NUM')
+        yield columns
+        for batch in dataset.to_batches(columns=columns, filter=scanFilter,
+                                        batch_size=CHUNK_ROWS):
+            frame = batch.to_pandas()
+            for col in frame.columns:
+                frame[col] = frame[col].astype(str)
+            for values in frame.values.tolist():
+                yield values
+        return
+    with open(source, 'r', newline='') as f:
+        for values in csv.reader(f):
+            yield values
+
+
+def open_findings_db():
+    global args
+    global outputDir
+    if args.findingsDb:
+        dbName = args.findingsDb
+    else:
+        dbName = outputDir + '/findings.db'
+    db = sqlite3.connect(dbName)
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS scans (
+            scan_id TEXT PRIMARY KEY, scan_time INTEGER);
+        CREATE TABLE IF NOT EXISTS accounts (
+            account_num TEXT PRIMARY KEY, profile TEXT);
+        CREATE TABLE IF NOT EXISTS scan_accounts (
+            scan_id TEXT, account_num TEXT,
+            PRIMARY KEY (scan_id, account_num));
+        CREATE TABLE IF NOT EXISTS checks (
+            title_id TEXT PRIMARY KEY, level TEXT, scored TEXT,
+            title_text TEXT);
+        CREATE TABLE IF NOT EXISTS results (
+            scan_id TEXT, account_num TEXT, title_id TEXT, region TEXT,
+            result TEXT, notes TEXT);
+        CREATE INDEX IF NOT EXISTS results_account_check_scan
+            ON results (account_num, title_id, scan_id);
+        CREATE INDEX IF NOT EXISTS results_scan_result
+            ON results (scan_id, result);
+    ''')
+    return db
+
+
+def store_findings(resultFileName, scanId, scanTime):
+    # Load one scan's results CSV into the findings database, replacing
+    # anything already stored for that scan
+    global logging
+    db = open_findings_db()
+    scanId = str(scanId)
+    with db:
+        db.execute('DELETE FROM results WHERE scan_id = ?', (scanId,))
+        db.execute('DELETE FROM scan_accounts WHERE scan_id = ?', (scanId,))
+        db.execute('INSERT OR REPLACE INTO scans VALUES (?, ?)',
+                   (scanId, int(scanTime)))
+        accounts = {}
+        checks = {}
+        batch = []
+        with open(resultFileName, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                accounts[row['ACCOUNT_NUM']] = row['PROFILE']
+                checks[row['TITLE_ID']] = (row['LEVEL'], row['SCORED'],
+                                           row['TITLE_TEXT'])
+                batch.append((scanId, row['ACCOUNT_NUM'], row['TITLE_ID'],
+                              row['REGION'], row['RESULT'], row['NOTES']))
+                if len(batch) >= 10000:
+                    db.executemany('INSERT INTO results VALUES '
+                                   '(?, ?, ?, ?, ?, ?)', batch)
+                    batch = []
+        db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                       batch)
+        db.executemany('INSERT OR REPLACE INTO accounts VALUES (?, ?)',
+                       accounts.items())
+        db.executemany('INSERT INTO scan_accounts VALUES (?, ?)',
+                       [(scanId, a) for a in accounts])
+        db.executemany('INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?)',
+                       [(k,) + v for k, v in checks.items()])
+    db.close()
+    logging.info("Stored scan " + scanId + " in the findings database")
+
+
+def diff_scans(scanA, scanB):
+    # New, fixed and still failing findings per account, for accounts
+    # present in both scans. A finding is a FAIL row identified by
+    # account, check, region and notes.
+    global outputDir
+    db = open_findings_db()
+    for scanId in [scanA, scanB]:
+        if db.execute('SELECT 1 FROM scans WHERE scan_id = ?',
+                      (scanId,)).fetchone() is None:
+            print("Scan not found in findings database: " + scanId)
+            logging.error("Scan not found in findings database: " + scanId)
+            db.close()
+            sys.exit(1)
+    query = '''
+        SELECT :status AS status, x.account_num, ac.profile, x.title_id,
+               x.region, ch.title_text, x.notes
+        FROM results x
+        JOIN scan_accounts sa
+          ON sa.scan_id = :other AND sa.account_num = x.account_num
+        LEFT JOIN accounts ac ON ac.account_num = x.account_num
+        LEFT JOIN checks ch ON ch.title_id = x.title_id
+        WHERE x.scan_id = :this AND x.result = 'FAIL' AND {} EXISTS (
+            SELECT 1 FROM results y
+            WHERE y.account_num = x.account_num
+              AND y.title_id = x.title_id AND y.scan_id = :other
+              AND y.region = x.region AND y.notes = x.notes
+              AND y.result = 'FAIL')
+    '''
+    rows = []
+    for status, this, other, cond in [('NEW', scanB, scanA, 'NOT'),
+                                      ('FIXED', scanA, scanB, 'NOT'),
+                                      ('STILL_FAILING', scanB, scanA, '')]:
+        rows += db.execute(query.format(cond), {
+            'status': status, 'this': this, 'other': other}).fetchall()
+    db.close()
+    diffName = outputDir + '/diff-' + scanA + '-' + scanB + '.csv'
+    with open(diffName, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['STATUS', 'ACCOUNT_NUM', 'PROFILE', 'TITLE_ID',
+                         'REGION', 'TITLE_TEXT', 'NOTES'])
+        writer.writerows(sorted(rows, key=lambda r: (r[1], r[0], r[3])))
+    summary = {}
+    for row in rows:
+        counts = summary.setdefault((row[1], row[2]), {
+            'NEW': 0, 'FIXED': 0, 'STILL_FAILING': 0})
+        counts[row[0]] += 1
+    for (account, profile), counts in sorted(summary.items()):
+        print("{} ({}): {} new, {} fixed, {} still failing".format(
+            account, profile, counts['NEW'], counts['FIXED'],
+            counts['STILL_FAILING']))
+    print("Diff File: " + diffName)
+
+
+def process_results(resultFileName, parts=None):
+    # parts are the (counts, rows) of every unit when they were aggregated
+    # during the scan, otherwise the results are aggregated here
     global args
     global logging
     if 'verbose' in globals():
         verbose = True
     else:
         verbose = False
-    if args.resultsFile:
+    if args.resultsFile and os.path.isdir(args.resultsFile):
+        excelName = os.path.join(
+            os.path.dirname(os.path.abspath(args.resultsFile)),
+            'results-' + str(args.scanId or 'dataset') + '.xlsx')
+    elif args.resultsFile:
         excelName = args.resultsFile.split('.')[0] + '.xlsx'
     else:
         excelName = 'results-'+str(int(scanTime))+'-'+str(scanUUID)+'.xlsx'
     if 'outputDir' in globals():
         excelName = outputDir + '/' + excelName
-    p_df = pd.read_csv(resultFileName,
-                       dtype={'ACCOUNT_NUM': str, 'TITLE_ID': str})
+    # First pass: aggregate the results CSV chunk by chunk
+    keys = ['TITLE_ID', 'LEVEL', 'SCORED', 'TITLE_TEXT',
+            'PROFILE', 'ACCOUNT_NUM', 'RESULT']
+    with stage_timer('aggregate'):
+        if parts is None:
+            parts = []
+            for chunk in iter_result_chunks(resultFileName, keys):
+                parts.append((aggregate_results(chunk), len(chunk)))
+        rowCount = sum(rows for c, rows in parts)
+        sheets = build_report_sheets(combine_counts([c for c, rows
+                                                     in parts]))
     if verbose:
-        print(p_df.shape)
-        print(p_df)
-    writer = pd.ExcelWriter(excelName, engine='xlsxwriter')
-    workbook = writer.book
+        print(str(rowCount) + " result rows")
+    # constant_memory flushes each row to disk once it is written, so the
+    # workbook never holds more than one row per sheet
+    workbook = xlsxwriter.Workbook(excelName, {'constant_memory': True})
 
     # Write Summary first
-    q3 = ('(LEVEL == "Level 1" or LEVEL == "Level 2") and '
-          '(RESULT == "PASS" or RESULT == "FAIL")')
-    p_df_pass = p_df.query(q3)
-    if verbose:
-        print(p_df_pass)
-    p_df_pass.groupby(['PROFILE', 'ACCOUNT_NUM', 'RESULT'])['RESULT'].count().to_excel(writer, sheet_name="Summary")
-    worksheet = writer.sheets['Summary']
-    for i, width in enumerate(get_col_widths(p_df, False)):
-        worksheet.set_column(i, i, width)
+    with stage_timer('excel:Summary'):
+        write_summary(workbook, sheets[0][1])
 
-    # Write raw results to Excel
-    p_df.to_excel(writer, sheet_name='RawResults', index=False)
-    worksheet = writer.sheets['RawResults']
-    for i, width in enumerate(get_col_widths(p_df, False)):
-        worksheet.set_column(i, i, width)
+    # Second pass: stream raw results to Excel
+    with stage_timer('excel:RawResults'):
+        write_raw_results(workbook, read_result_rows(resultFileName))
 
-    # Write Passing results to Excel
-    q1 = 'RESULT == "PASS"'
-    p_df_pass = pd.pivot_table(
-        p_df.query(q1),
-        index=['TITLE_ID', 'TITLE_TEXT'],
-        columns=['PROFILE', 'ACCOUNT_NUM'], values='RESULT',
-        aggfunc=np.count_nonzero, fill_value=0)
-    p_df_pass.to_excel(writer, sheet_name="All Passing")
-
-    # Write Failing results to Excel
-    q2 = 'RESULT == "FAIL"'
-    p_df_fail = pd.pivot_table(
-        p_df.query(q2),
-        index=['TITLE_ID', 'TITLE_TEXT'],
-        columns=['PROFILE', 'ACCOUNT_NUM'], values='RESULT',
-        aggfunc=np.count_nonzero, fill_value=0)
-    p_df_fail.to_excel(writer, sheet_name="All Failing")
-
-    # Write CIS Benchmarks Passing results to Excel
-    q3 = 'RESULT == "PASS" and (LEVEL == "Level 1" or LEVEL == "Level 2")'
-    p_df_cis_pass = pd.pivot_table(
-        p_df.query(q1),
-        index=['TITLE_ID', 'LEVEL', 'SCORED', 'TITLE_TEXT'],
-        columns=['PROFILE', 'ACCOUNT_NUM'], values='RESULT',
-        aggfunc=np.count_nonzero, fill_value=0)
-    p_df_cis_pass.to_excel(writer, sheet_name="CIS Benchmarks Passing")
-
-    # Write CIS Benchmarks failing results to Excel
-    q4 = 'RESULT == "FAIL" and (LEVEL == "Level 1" or LEVEL == "Level 2")'
-    p_df_cis_fail = pd.pivot_table(
-        p_df.query(q2),
-        index=['TITLE_ID', 'LEVEL', 'SCORED', 'TITLE_TEXT'],
-        columns=['PROFILE', 'ACCOUNT_NUM'], values='RESULT',
-        aggfunc=np.count_nonzero, fill_value=0)
-    p_df_cis_fail.to_excel(writer, sheet_name="CIS Benchmarks Failing")
+    # Write the Passing / Failing and CIS Benchmarks pivots to Excel
+    for name, sheet in sheets[1:]:
+        with stage_timer('excel:' + name):
+            write_sheet(workbook, name, sheet)
 
     print("Report Excel File: " + excelName)
-    writer.save()
+    workbook.close()
 
 
 def main():
@@ -405,62 +2428,95 @@ def main():
     setup_args(parser)
     global args
     args = parser.parse_args()
-    if not args.resultsFile:
-        process_args(args)
+    # Installed for the whole run, so SIGUSR1 never ends a scan. Workers
+    # have no report to write.
+    signal.signal(signal.SIGUSR1,
+                  signal.SIG_IGN if args.worker else request_partial)
+    if args.diff:
+        check_args_outputDir(args)
+        check_args_debug(args)
+        diff_scans(args.diff[0], args.diff[1])
+    elif args.worker:
+        with stage_timer('validation'):
+            process_args(args)
+        run_worker(args.worker)
+    elif not args.resultsFile:
+        with stage_timer('validation'):
+            process_args(args)
         global resultDict
+        global unitCounts
         resultDict = {}
+        unitCounts = {}
         global scanUUID
         global scanTime
-        # Generate a Testing UUID and TimeStamp to add to logs / results
-        scanUUID = uuid.uuid4()
-        scanTime = time.time()
+        global durationDict
+        global manifest
+        durationDict = load_durations()
+        if args.resume:
+            # Pick up the UUID, TimeStamp and work units of the old scan
+            units = load_manifest(args.resume)
+            for x, entry in manifest['units'].items():
+                if entry['state'] == 'done':
+                    resultDict[x] = entry['file']
+            print("Resuming scan " + str(scanUUID) + ": "
+                  + str(len(resultDict)) + " of " + str(len(units))
+                  + " work units already done")
+        else:
+            # Generate a Testing UUID and TimeStamp to add to logs / results
+            scanUUID = uuid.uuid4()
+            scanTime = time.time()
+            units = build_units(workingProfiles)
+            new_manifest(units)
         logging.info(scanUUID)
         logging.info(int(scanTime))
         if verbose:
             print(scanUUID)
             print(int(scanTime))
 
-        # setting up queues
-
-        global q
-        q = queue.Queue()
-
-        # process workingProfiles, run assessment tool(s) against each Profile
-        for x in workingProfiles:
-            q.put(x)
-        if args.maxthreads and args.maxthreads > 0:
-            maxthreads = int(args.maxthreads)
-        else:
-            maxthreads = psutil.cpu_count(logical=False)
-        threads = [threading.Thread(target=worker) for _i in range(maxthreads)]
-        for thread in threads:
-            thread.start()
-            q.put(None)  # one EOF marker for each thread
-
-        for thread in threads:
-            thread.join()
+        # process workingProfiles, run assessment tool(s) against each
+        # Profile / Region / Check work unit, longest jobs first
+        todo = [x for x in order_units(units, durationDict)
+                if manifest['units'][unit_key(x)]['state'] != 'done']
+        if args.maxAge > 0 and not args.coordinator:
+            global prowlerRelease
+            prowlerRelease = prowler_version()
+            if not args.force:
+                todo = serve_cached_units(todo)
+        minthreads, maxthreads = thread_limits()
+        with stage_timer('scan'):
+            if args.coordinator:
+                publish_units(args.coordinator, todo)
+                collect_units(args.coordinator, todo)
+            else:
+                if args.apiCache:
+                    start_api_cache()
+                asyncio.run(run_scan(todo, minthreads, maxthreads))
+                if args.apiCache:
+                    stop_api_cache()
+        save_durations(durationDict)
+        save_manifest()
 
-        header = False
         resultFileName = 'results-'+str(int(scanTime))+'-'+str(scanUUID)+'.csv'
         resultFileName = outputDir + '/' + resultFileName
-        print("Opening CSV")
-        resultFile = open(resultFileName, 'w+')
-        for key in resultDict:
-            print("resultDict Key: " + key)
-            print("Value:")
-            print(resultDict[key])
-
-            for i in range(len(resultDict[key].split('\n'))):
-                if header:
-                    if 'ACCOUNT_NUM' not in resultDict[key].split('\n')[i]:
-                        resultFile.write(resultDict[key].split('\n')[i] + "\n")
-                else:
-                    print("Writing Headers")
-                    resultFile.write(resultDict[key].split('\n')[0] + "\n")
-                    header = True
-        resultFile.close()
+        # Shards are merged back together per account
+        with stage_timer('merge'):
+            merge_results(resultFileName,
+                          [resultDict[unit_key(u)] for u in units
+                           if unit_key(u) in resultDict])
         print("Result File: " + resultFileName)
-        process_results(resultFileName)
+        with stage_timer('dataset'):
+            write_result_dataset(resultFileName,
+                                 outputDir + '/results-dataset', scanUUID)
+        with stage_timer('findingsDb'):
+            store_findings(resultFileName, scanUUID, scanTime)
+        # Units finished by an earlier run of a resumed scan
+        for x, fname in resultDict.items():
+            if x not in unitCounts:
+                unitCounts[x] = aggregate_file(fname)
+        with stage_timer('report'):
+            process_results(resultFileName,
+                            [unitCounts[x] for x in resultDict])
+        export_metrics()
     else:
         if os.path.exists(args.resultsFile):
             process_results(args.resultsFile)